@@ -0,0 +1,5 @@
+import os
+import sys
+
+# video_cdn_helper.py is a standalone script in lib/, not a package
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
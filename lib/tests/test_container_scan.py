@@ -0,0 +1,111 @@
+import struct
+
+import pytest
+
+import video_cdn_helper as helper
+
+def box(box_type, payload=b''):
+  return struct.pack('>I', 8 + len(payload)) + box_type + payload
+
+def full_box(box_type, payload):
+  return box(box_type, b'\0\0\0\0' + payload)
+
+def sample_table(chunk_offsets, stsc_runs):
+  stco = full_box(b'stco', struct.pack('>I', len(chunk_offsets)) + b''.join(struct.pack('>I', o) for o in chunk_offsets))
+  stsc = full_box(b'stsc', struct.pack('>I', len(stsc_runs)) +
+                  b''.join(struct.pack('>III', first_chunk, samples, 1) for first_chunk, samples in stsc_runs))
+  return box(b'stbl', stsc + stco)
+
+def mp4(chunk_offsets=(1000, 5000), stsc_runs=((1, 10), (2, 5)), moov_first=True, mdat_bytes=10000):
+  ftyp = box(b'ftyp', b'isom\0\0\2\0isomiso2avc1mp41')
+  moov = box(b'moov', full_box(b'mvhd', b'\0' * 96) +
+             box(b'trak', box(b'mdia', box(b'minf', sample_table(chunk_offsets, stsc_runs)))))
+  mdat = box(b'mdat', b'\xab' * mdat_bytes)
+  return ftyp + (moov + mdat if moov_first else mdat + moov)
+
+@pytest.fixture
+def scan(tmp_path):
+  def scan(data):
+    path = tmp_path / 'input.mp4'
+    path.write_bytes(data)
+    return helper.scan_container(str(path))
+  return scan
+
+def test_faststart_file_is_clean(scan):
+  result = scan(mp4())
+  assert result.is_mp4 and result.has_moov
+  assert [box_type for box_type, _, _ in result.boxes] == ['ftyp', 'moov', 'mdat']
+  assert not result.moov_at_end
+  assert result.problems == []
+  assert helper.classify_input(None, result)[0] == 'healthy'
+
+def test_moov_at_end_is_not_a_problem(scan):
+  result = scan(mp4(moov_first=False))
+  assert result.moov_at_end
+  assert result.problems == []
+
+def test_truncated_mdat_with_moov_is_damaged(scan):
+  data = mp4()
+  result = scan(data[:len(data) - 4000])
+  assert result.truncated and result.has_moov
+  assert helper.classify_input(None, result)[0] == 'damaged'
+
+def test_truncated_download_without_moov(scan):
+  data = mp4(moov_first=False)
+  result = scan(data[:6000])
+  assert result.truncated and result.missing_moov
+  assert helper.classify_input(None, result)[0] == 'missing_moov'
+
+def test_truncated_inside_moov_counts_as_missing(scan):
+  data = mp4()
+  moov_end = data.index(b'mdat') - 4
+  result = scan(data[:moov_end - 10])
+  assert result.missing_moov
+  assert helper.classify_input(None, result)[0] == 'missing_moov'
+
+def test_chunk_offset_past_eof(scan):
+  result = scan(mp4(chunk_offsets=(1000, 900000)))
+  assert result.bad_sample_tables and not result.truncated
+  assert 'past the end of the file' in result.problems[0]
+  assert helper.classify_input(None, result)[0] == 'metadata_corrupt'
+
+def test_stsc_runs_out_of_order(scan):
+  result = scan(mp4(stsc_runs=((3, 10), (2, 5))))
+  assert result.bad_sample_tables
+  assert helper.classify_input(None, result)[0] == 'metadata_corrupt'
+
+def test_stsc_referencing_missing_chunks(scan):
+  result = scan(mp4(chunk_offsets=(1000,), stsc_runs=((1, 10), (2, 5))))
+  assert result.bad_sample_tables
+
+def test_box_size_beyond_parent(scan):
+  data = bytearray(mp4())
+  mvhd = data.index(b'mvhd') - 4
+  data[mvhd:mvhd + 4] = struct.pack('>I', 100000)
+  result = scan(bytes(data))
+  assert result.bad_sizes
+  assert helper.classify_input(None, result)[0] == 'damaged'
+
+@pytest.mark.parametrize('padding', [3, 8, 4096])
+def test_trailing_zero_padding_is_harmless(scan, padding):
+  result = scan(mp4() + b'\0' * padding)
+  assert result.problems == []
+  assert result.padding_bytes == padding
+  assert helper.classify_input(None, result)[0] == 'healthy'
+
+def test_trailing_garbage_is_reported(scan):
+  result = scan(mp4() + b'\x01\x02\x03')
+  assert result.truncated
+  assert helper.classify_input(None, result)[0] == 'damaged'
+
+def test_non_mp4_is_left_to_ffprobe(scan):
+  result = scan(b'\x1a\x45\xdf\xa3' + b'\0' * 100)
+  assert not result.is_mp4
+  assert result.problems == []
+
+def test_scan_problems_rule_out_the_remux_fast_path(scan):
+  media = helper.MediaInfo(ok=True, container='mov,mp4,m4a,3gp,3g2,mj2', duration=5.0, bit_rate=1_000_000,
+                           video_codec='h264', pix_fmt='yuv420p', width=1280, height=720, audio_codec='aac')
+  data = mp4()
+  assert helper.is_web_ready(media, len(data), scan(data))
+  assert not helper.is_web_ready(media, len(data), scan(data[:len(data) - 4000]))
@@ -0,0 +1,41 @@
+import subprocess
+
+import pytest
+
+import video_cdn_helper as helper
+
+def test_encode_budget_grows_with_duration(monkeypatch):
+  monkeypatch.setattr(helper, 'MAX_ENCODE_SECONDS', 1800.0)
+  monkeypatch.setattr(helper, 'ENCODE_SECONDS_PER_MEDIA_SECOND', 4.0)
+  assert helper.encode_time_budget(None) == 1800.0
+  assert helper.encode_time_budget(helper.MediaInfo(ok=True, duration=60.0)) == 1800.0
+  assert helper.encode_time_budget(helper.MediaInfo(ok=True, duration=7200.0)) == 28800.0
+
+def test_slow_seed_encode_is_a_timeout_not_corruption(tmp_path, monkeypatch):
+  source = tmp_path / 'long_seed.mp4'
+  source.write_bytes(b'')
+  commands = []
+  def run_ffmpeg(cmd, timeout=None, stage=None, duration=None):
+    commands.append(cmd)
+    raise subprocess.TimeoutExpired(cmd, timeout)
+  monkeypatch.setattr(helper, 'run_ffmpeg', run_ffmpeg)
+  report = {}
+  with pytest.raises(subprocess.TimeoutExpired) as raised:
+    helper.encode_with_plan(str(source), str(tmp_path / 'out.mp4'), 'ffmpeg', None, None, [], report)
+  # A timeout ends the plan instead of trying the next strategy
+  assert report['strategies_tried'] == ['standard'] and len(commands) == 1
+  assert helper.exit_code_for_error(raised.value) == 2
+
+def test_thread_cap_covers_decoders_and_filters():
+  commands, _ = helper.build_strategy('remux_then_encode', 'in.mp4', 'out.mp4', 'ffmpeg', ['-threads', '2'])
+  limited = helper.with_thread_limits(commands[1], ['-threads', '2'])
+  assert limited[:3] == ['ffmpeg', '-filter_threads', '2']
+  assert limited[limited.index('-i') - 2:limited.index('-i')] == ['-threads', '2']
+  assert limited[-3:] == ['-threads', '2', 'out.mp4']
+  # av1_safe decodes single-threaded on purpose
+  commands, _ = helper.build_strategy('av1_safe', 'in.mp4', 'out.mp4', 'ffmpeg', ['-threads', '2'])
+  limited = helper.with_thread_limits(commands[0], ['-threads', '2'])
+  input_options = limited[:limited.index('-i')]
+  assert input_options.count('-threads') == 1
+  assert input_options[input_options.index('-threads') + 1] == '1'
+  assert helper.with_thread_limits(commands[0], []) == commands[0]
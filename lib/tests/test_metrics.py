@@ -0,0 +1,50 @@
+import pytest
+
+import video_cdn_helper as helper
+
+@pytest.fixture
+def metrics(tmp_path, monkeypatch):
+  monkeypatch.setattr(helper, 'CACHE_DB_PATH', str(tmp_path / 'cache.sqlite3'))
+  monkeypatch.setenv('VIDEO_CDN_METRICS_FILE', str(tmp_path / 'video_cdn.prom'))
+  monkeypatch.delenv('VIDEO_CDN_TRACE_FILE', raising=False)
+  monkeypatch.delenv('VIDEO_CDN_DEDUP', raising=False)
+  def read():
+    values = {}
+    for line in (tmp_path / 'video_cdn.prom').read_text().splitlines():
+      if not line.startswith('#'):
+        name, value = line.rsplit(' ', 1)
+        values[name] = float(value)
+    return values
+  return read
+
+def test_dedup_hits_do_not_recount_the_original_job(tmp_path, metrics, monkeypatch):
+  source = tmp_path / 'clip.mp4'
+  source.write_bytes(b'same content')
+  uploaded = tmp_path / 'uploaded.mp4'
+  uploaded.write_bytes(b'encoded')
+  def transcode_and_upload_video(path, threads=None, report=None):
+    report.update({'output_bytes': 1000, 'upload_retries': 2, 'strategy': 'standard', 'encode_path': 'transcode',
+                   'destination': 'fake', 'width': 640, 'height': 360, 'duration': 4.0})
+    return f"file://{uploaded}"
+  monkeypatch.setattr(helper, 'transcode_and_upload_video', transcode_and_upload_video)
+  helper.process_video(str(source))
+  for _ in range(3):
+    result = helper.process_video(str(source))
+  assert result['dedup_hit'] and result['url'] == f"file://{uploaded}"
+  assert (result['width'], result['height'], result['destination']) == (640, 360, 'fake')
+  assert 'upload_retries' not in result and 'output_bytes' not in result
+  values = metrics()
+  assert values['video_cdn_dedup_hits_total'] == 3
+  assert values['video_cdn_bytes_out_total'] == 1000
+  assert values['video_cdn_upload_retries_total'] == 2
+
+def test_unknown_forced_backend_fails_before_any_work(tmp_path, metrics, monkeypatch):
+  source = tmp_path / 'clip.mp4'
+  source.write_bytes(b'content')
+  monkeypatch.setenv('VIDEO_CDN_STORAGE_BACKEND', 'gsc')
+  def transcode_and_upload_video(path, threads=None, report=None):
+    raise AssertionError('encoded despite an unknown backend')
+  monkeypatch.setattr(helper, 'transcode_and_upload_video', transcode_and_upload_video)
+  with pytest.raises(ValueError, match="Unknown storage backend 'gsc'"):
+    helper.process_video(str(source))
+  assert metrics()['video_cdn_jobs_total{outcome="error"}'] == 1
@@ -0,0 +1,103 @@
+import os
+import sqlite3
+import subprocess
+import threading
+import time
+
+import pytest
+
+import video_cdn_helper as helper
+
+@pytest.fixture
+def scratch(tmp_path, monkeypatch):
+  monkeypatch.setattr(helper, 'CACHE_DB_PATH', str(tmp_path / 'cache.sqlite3'))
+  monkeypatch.setattr(helper, 'SCRATCH_DIR', str(tmp_path / 'scratch'))
+  monkeypatch.setattr(helper, 'SCRATCH_TOTAL_BYTES', 100 * 1024 * 1024)
+  monkeypatch.setattr(helper, 'SCRATCH_JOB_BYTES', 0)
+  monkeypatch.setattr(helper, 'SCRATCH_WAIT_SECONDS', 5.0)
+  monkeypatch.setattr(helper, 'SCRATCH_POLL_SECONDS', 0.02)
+  workspaces = []
+  def workspace(reserve_mb, limit_bytes=0):
+    ws = helper.ScratchWorkspace(reserve_mb * 1024 * 1024, limit_bytes)
+    workspaces.append(ws)
+    return ws
+  yield workspace
+  for ws in workspaces:
+    if ws.path and os.path.isdir(ws.path):
+      ws.release()
+    else:
+      ws._stop.set()  # Released or reclaimed by the test already
+
+def ledger():
+  with sqlite3.connect(helper.CACHE_DB_PATH) as conn:
+    return conn.execute('SELECT path, pid, bytes FROM scratch_reservations ORDER BY created_at').fetchall()
+
+def test_jobs_that_fit_are_admitted_together(scratch):
+  first, second = scratch(40), scratch(40)
+  first.reserve()
+  second.reserve()
+  assert os.path.isdir(first.path) and os.path.isdir(second.path)
+  assert [size for _, _, size in ledger()] == [40 * 1024 * 1024] * 2
+  first.release()
+  assert not os.path.exists(first.path)
+  assert [path for path, _, _ in ledger()] == [second.path]
+
+def test_job_over_budget_waits_for_a_release(scratch):
+  first, second = scratch(70), scratch(70)
+  first.reserve()
+  releaser = threading.Timer(0.2, first.release)
+  releaser.start()
+  started = time.monotonic()
+  second.reserve()
+  releaser.join()
+  assert time.monotonic() - started >= 0.2
+  assert [path for path, _, _ in ledger()] == [second.path]
+
+def test_job_over_budget_gives_up_after_the_wait(scratch, monkeypatch):
+  monkeypatch.setattr(helper, 'SCRATCH_WAIT_SECONDS', 0.1)
+  first, second = scratch(70), scratch(70)
+  first.reserve()
+  with pytest.raises(helper.ScratchBudgetError, match='No scratch space'):
+    second.reserve()
+  assert second.path is None
+  assert os.listdir(helper.SCRATCH_DIR) == [os.path.basename(first.path)]
+
+def test_job_larger_than_the_budget_runs_alone(scratch):
+  solo = scratch(500)
+  solo.reserve()
+  assert [size for _, _, size in ledger()] == [500 * 1024 * 1024]
+
+def test_dead_jobs_are_reclaimed(scratch):
+  dead = subprocess.Popen(['true'])
+  dead.wait()
+  stale = scratch(90)
+  stale.reserve()
+  with sqlite3.connect(helper.CACHE_DB_PATH) as conn:
+    conn.execute('UPDATE scratch_reservations SET pid = ?', (dead.pid,))
+  job = scratch(50)
+  job.reserve()
+  assert not os.path.exists(stale.path)
+  assert [path for path, _, _ in ledger()] == [job.path]
+
+def test_watchdog_stops_a_job_over_its_limit(scratch, tmp_path, monkeypatch):
+  # Stands in for ffmpeg: fills the scratch directory, then keeps running
+  writer = tmp_path / 'fake_ffmpeg'
+  writer.write_text('#!/bin/sh\nhead -c 2097152 /dev/zero > "$2"\nexec sleep 30\n')
+  writer.chmod(0o755)
+  ws = scratch(1, limit_bytes=1024 * 1024)
+  ws.reserve()
+  monkeypatch.setattr(helper, '_active_workspace', ws)
+  started = time.monotonic()
+  with pytest.raises(helper.ScratchBudgetError, match='over 1048576 bytes'):
+    helper.run_ffmpeg([str(writer), ws.file('out.mp4')], timeout=20)
+  assert time.monotonic() - started < 10
+  assert ws.exceeded and ws.peak_bytes > 1024 * 1024
+
+def test_reservation_is_the_default_job_limit(scratch, tmp_path, monkeypatch):
+  source = tmp_path / 'clip.mp4'
+  source.write_bytes(b'\0' * 1000)
+  with helper.scratch_workspace(str(source), {}) as ws:
+    assert ws.limit_bytes == ws.reserve_bytes == int(1000 * helper.SCRATCH_INPUT_FACTOR) + helper.SCRATCH_OVERHEAD_BYTES
+  monkeypatch.setattr(helper, 'SCRATCH_JOB_BYTES', 8 * 1024 * 1024)
+  with helper.scratch_workspace(str(source), {}) as ws:
+    assert ws.limit_bytes == ws.reserve_bytes == 8 * 1024 * 1024
@@ -0,0 +1,41 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+import video_cdn_helper as helper
+
+WEB_READY = helper.MediaInfo(ok=True, container='mov,mp4,m4a,3gp,3g2,mj2', duration=5.0, bit_rate=1_000_000,
+                             video_codec='h264', pix_fmt='yuv420p', width=1280, height=720, audio_codec='aac')
+
+@pytest.fixture
+def stream(tmp_path, monkeypatch):
+  monkeypatch.setattr(helper, 'PUBLIC_VIDEOS_DIR', str(tmp_path / 'public'))
+  monkeypatch.setenv('VIDEO_CDN_STORAGE_BACKEND', 'public')
+  def stream(script):
+    # Stands in for ffmpeg writing fragmented MP4 to stdout
+    fake_ffmpeg = tmp_path / 'fake_ffmpeg'
+    fake_ffmpeg.write_text('#!/bin/sh\n' + script)
+    fake_ffmpeg.chmod(0o755)
+    report = {'expected_output_bytes': helper.CLOUDINARY_MAX_BYTES + 1}
+    url = helper.stream_encode_and_upload(str(tmp_path / 'in.mp4'), str(tmp_path / 'in_compressed.mp4'),
+                                          str(fake_ffmpeg), WEB_READY, None, [], report)
+    return url, report
+  return stream
+
+def test_streamed_bytes_are_recorded_as_output(stream):
+  url, report = stream('head -c 300000 /dev/zero\n')
+  assert url == '/videos/in_compressed.mp4'
+  assert report['streamed'] and report['output_bytes'] == 300000
+  assert os.path.getsize(os.path.join(helper.PUBLIC_VIDEOS_DIR, 'in_compressed.mp4')) == 300000
+
+def test_stream_stops_at_the_encode_budget(stream, monkeypatch):
+  monkeypatch.setattr(helper, 'MAX_ENCODE_SECONDS', 0.5)
+  monkeypatch.setattr(helper, 'ENCODE_SECONDS_PER_MEDIA_SECOND', 0.0)
+  started = time.monotonic()
+  with pytest.raises(subprocess.TimeoutExpired):
+    stream('head -c 1000 /dev/zero\nexec sleep 30\n')
+  assert time.monotonic() - started < 10
+  # The partial output is not left behind
+  assert not os.path.exists(os.path.join(helper.PUBLIC_VIDEOS_DIR, 'in_compressed.mp4'))
@@ -0,0 +1,225 @@
+import io
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import video_cdn_helper as helper
+
+class FakeSessionServer(ThreadingHTTPServer):
+  """
+  A single GCS-style resumable upload session. faults maps the index of a
+  PUT to what goes wrong with it:
+    drop     keep half the chunk, then close the connection with no reply
+    error    keep half the chunk, then answer 503
+    partial  keep half the chunk and acknowledge only that (308)
+    stall    keep nothing and acknowledge nothing new (308)
+    forbid   answer 403
+  """
+  daemon_threads = True
+
+  def __init__(self, faults=None):
+    super().__init__(('127.0.0.1', 0), FakeSessionHandler)
+    self.faults = dict(faults or {})
+    self.received = bytearray()
+    self.ranges = []  # Content-Range of every PUT, in order
+    self.errors = []
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+  @property
+  def url(self):
+    return f"http://127.0.0.1:{self.server_port}/session"
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.shutdown()
+    self.server_close()
+
+class FakeSessionHandler(BaseHTTPRequestHandler):
+  def log_message(self, *args):
+    pass
+
+  def _reply(self, status, body=None):
+    server = self.server
+    payload = json.dumps(body).encode() if body is not None else b''
+    self.send_response(status)
+    if status == 308 and server.received:
+      self.send_header('Range', f"bytes=0-{len(server.received) - 1}")
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def do_PUT(self):
+    server = self.server
+    content_range = self.headers['Content-Range']
+    data = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+    fault = server.faults.pop(len(server.ranges), None)
+    server.ranges.append(content_range)
+    byte_range, total = content_range[len('bytes '):].split('/')
+    if byte_range != '*' and int(byte_range.split('-')[0]) != len(server.received):
+      server.errors.append(f"{content_range} does not continue from {len(server.received)}")
+      return self._reply(400)
+    if fault == 'forbid':
+      return self._reply(403)
+    if fault == 'stall':
+      return self._reply(308)
+    if fault in ('drop', 'error', 'partial'):
+      server.received.extend(data[:len(data) // 2])
+      if fault == 'drop':
+        return
+      return self._reply(503 if fault == 'error' else 308)
+    server.received.extend(data)
+    if total != '*' and len(server.received) == int(total):
+      return self._reply(200, {'size': len(server.received)})
+    self._reply(308)
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+  monkeypatch.setattr(helper, '_backoff', lambda attempt: None)
+
+@pytest.fixture
+def payload(tmp_path):
+  data = bytes(range(256)) * 40  # 10240 bytes: two full 4 KiB chunks and a short one
+  path = tmp_path / 'video.mp4'
+  path.write_bytes(data)
+  return str(path), data
+
+def upload(server, path, stats=None, **kwargs):
+  kwargs.setdefault('chunk_size', 4096)
+  return helper.upload_file_to_session(server.url, path, stats=stats, **kwargs)
+
+def test_session_upload_in_chunks(payload):
+  path, data = payload
+  with FakeSessionServer() as server:
+    assert upload(server, path) == {'size': len(data)}
+  assert bytes(server.received) == data
+  assert server.ranges == ['bytes 0-4095/*', 'bytes 4096-8191/*', 'bytes 8192-10239/10240']
+  assert server.errors == []
+
+@pytest.mark.parametrize('fault', ['drop', 'error'])
+def test_failed_chunk_resumes_from_the_session_range(payload, fault):
+  path, data = payload
+  stats = {}
+  with FakeSessionServer(faults={1: fault}) as server:
+    upload(server, path, stats)
+  assert bytes(server.received) == data
+  assert server.errors == []
+  # Half of the second chunk was kept, so the resend starts where the session left off
+  assert server.ranges[2] == 'bytes */*'
+  assert server.ranges[3] == 'bytes 6144-10239/*'
+  assert stats['upload_retries'] == 1
+
+def test_partial_acknowledgement_resends_the_remainder(payload):
+  path, data = payload
+  stats = {}
+  with FakeSessionServer(faults={0: 'partial'}) as server:
+    upload(server, path, stats)
+  assert bytes(server.received) == data
+  assert server.ranges[:2] == ['bytes 0-4095/*', 'bytes 2048-6143/*']
+  assert server.errors == []
+  assert 'upload_retries' not in stats
+
+def test_stream_declares_total_only_with_the_last_chunk():
+  data = b'x' * 8192
+  with FakeSessionServer() as server:
+    helper.upload_stream_to_session(server.url, io.BytesIO(data), chunk_size=4096)
+  assert bytes(server.received) == data
+  # The stream ends on a chunk boundary, so the total goes up on an empty final request
+  assert server.ranges == ['bytes 0-4095/*', 'bytes 4096-8191/*', 'bytes */8192']
+
+def test_session_without_progress_gives_up(payload):
+  path, _ = payload
+  with FakeSessionServer(faults={n: 'stall' for n in range(10)}) as server:
+    with pytest.raises(IOError, match='no progress past offset 0'):
+      upload(server, path, max_retries=2)
+  assert len(server.ranges) == 3
+
+def test_client_error_is_not_retried(payload):
+  path, _ = payload
+  stats = {}
+  with FakeSessionServer(faults={1: 'forbid'}) as server:
+    with pytest.raises(helper.urllib.error.HTTPError) as raised:
+      upload(server, path, stats)
+  assert raised.value.code == 403
+  assert len(server.ranges) == 2
+  assert 'upload_retries' not in stats
+
+class FakeUploader:
+  """
+  Stands in for cloudinary.uploader; failures maps a chunk offset to the
+  exceptions its next attempts raise.
+  """
+  def __init__(self, failures=None):
+    self.failures = {offset: list(errors) for offset, errors in (failures or {}).items()}
+    self.calls = []
+
+  def upload_large_part(self, file, http_headers=None, **options):
+    content_range = http_headers['Content-Range']
+    self.calls.append((content_range, len(file[1]), dict(options)))
+    byte_range, total = content_range.split()[1].split('/')
+    first, last = (int(n) for n in byte_range.split('-'))
+    if self.failures.get(first):
+      raise self.failures[first].pop(0)
+    done = last + 1 == int(total)
+    return {'public_id': 'PlaylistViewer/video', 'secure_url': 'https://cdn/video.mp4' if done else None}
+
+def test_cloudinary_retries_only_the_failed_chunk(payload, monkeypatch):
+  path, _ = payload
+  uploader = FakeUploader(failures={4096: [ConnectionResetError('reset'), ConnectionResetError('reset')]})
+  monkeypatch.setattr(helper, 'load_cloudinary', lambda: uploader)
+  stats = {}
+  response = helper.upload_video_to_cloudinary(path, chunk_size=4096, stats=stats)
+  assert response['secure_url'] == 'https://cdn/video.mp4'
+  assert [content_range for content_range, _, _ in uploader.calls] == [
+    'bytes 0-4095/10240', 'bytes 4096-8191/10240', 'bytes 4096-8191/10240',
+    'bytes 4096-8191/10240', 'bytes 8192-10239/10240']
+  assert stats['upload_retries'] == 2
+  # Later chunks are tied to the asset the first one created
+  assert 'public_id' not in uploader.calls[0][2]
+  assert uploader.calls[-1][2]['public_id'] == 'PlaylistViewer/video'
+
+def test_cloudinary_size_rejection_is_not_retried(payload, monkeypatch):
+  path, _ = payload
+  uploader = FakeUploader(failures={0: [Exception('Error 413: Request Entity Too Large')]})
+  monkeypatch.setattr(helper, 'load_cloudinary', lambda: uploader)
+  stats = {}
+  with pytest.raises(Exception, match='413'):
+    helper.upload_video_to_cloudinary(path, chunk_size=4096, stats=stats)
+  assert len(uploader.calls) == 1
+  assert 'upload_retries' not in stats
+
+def test_cloudinary_gives_up_after_max_retries(payload, monkeypatch):
+  path, _ = payload
+  uploader = FakeUploader(failures={0: [TimeoutError('timed out')] * 5})
+  monkeypatch.setattr(helper, 'load_cloudinary', lambda: uploader)
+  with pytest.raises(TimeoutError):
+    helper.upload_video_to_cloudinary(path, chunk_size=4096, max_retries=2)
+  assert len(uploader.calls) == 3
+
+class BadRequest(Exception):
+  pass
+
+BadRequest.__module__ = 'cloudinary.exceptions'  # As the SDK raises a 400
+
+class StatusError(Exception):
+  def __init__(self, message, http_code):
+    super().__init__(message)
+    self.http_code = http_code
+
+@pytest.mark.parametrize('error, permanent', [
+  (BadRequest('File size too large. Got 120000000. Maximum is 104857600.'), True),
+  (StatusError('Forbidden', 403), True),
+  (helper.urllib.error.HTTPError('https://api', 401, 'Unauthorized', {}, None), True),
+  (Exception('413 Request Entity Too Large'), True),
+  (StatusError('Service Unavailable', 503), False),
+  (helper.urllib.error.HTTPError('https://api', 429, 'Too Many Requests', {}, None), False),
+  # Digits that merely look like a status code
+  (TimeoutError('read timed out after 400 seconds'), False),
+  (ConnectionResetError('chunk at offset 4030001 reset by peer'), False),
+])
+def test_permanent_upload_errors_are_classified_by_status(error, permanent):
+  assert helper._is_permanent_upload_error(error) == permanent
@@ -0,0 +1,35 @@
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+import video_cdn_helper as helper
+
+def test_socket_worker_refuses_to_replace_a_regular_file(tmp_path):
+  target = tmp_path / 'notes.txt'
+  target.write_text('keep me')
+  with pytest.raises(FileExistsError, match='not a socket'):
+    helper.run_socket_worker(str(target))
+  assert target.read_text() == 'keep me'
+  assert helper.main(['--socket', str(target)]) == 2
+
+def test_socket_worker_replaces_a_stale_socket_and_is_owner_only(tmp_path):
+  socket_path = str(tmp_path / 'worker.sock')
+  stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  stale.bind(socket_path)
+  stale.close()
+  threading.Thread(target=helper.run_socket_worker, args=(socket_path,), daemon=True).start()
+  for _ in range(100):
+    try:
+      with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall(b'{"id": 1}\n')
+        reply = client.makefile('r').readline()
+      break
+    except (ConnectionRefusedError, FileNotFoundError):
+      time.sleep(0.05)
+  assert '"ok": false' in reply
+  assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
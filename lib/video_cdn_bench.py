@@ -0,0 +1,491 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import shutil
+import struct
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Benchmark for video_cdn_helper.py. It builds synthetic inputs with ffmpeg
+# lavfi, runs the helper on each one in a fresh subprocess with Cloudinary
+# and GCS pointed at local stand-in servers, and records one JSON line per
+# run: wall time, CPU time, peak RSS, output size and which branch fired.
+#
+#   python lib/video_cdn_bench.py                          # standard suite
+#   python lib/video_cdn_bench.py --quick --repeat 3
+#   python lib/video_cdn_bench.py --out new.jsonl --baseline old.jsonl
+
+HELPER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'video_cdn_helper.py')
+FFMPEG_BIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), '../bin/ffmpeg')
+
+# Every input is generated from deterministic lavfi sources with bitexact
+# muxing, so the same ffmpeg build produces byte-identical inputs
+BITEXACT_ARGS = ['-fflags', '+bitexact', '-flags:v', '+bitexact', '-flags:a', '+bitexact', '-map_metadata', '-1']
+
+# name -> how to build it. 'quick' cases make up --quick; 'large' ones only run with --large.
+CASES = [
+  {'name': 'h264_360p_5s', 'size': '640x360', 'duration': 5, 'quick': True},
+  {'name': 'h264_720p_5s', 'size': '1280x720', 'duration': 5, 'quick': True},
+  {'name': 'h264_1080p_5s', 'size': '1920x1080', 'duration': 5},
+  {'name': 'h264_720p_30s', 'size': '1280x720', 'duration': 30},
+  {'name': 'h264_1080p_30s', 'size': '1920x1080', 'duration': 30},
+  {'name': 'h264_2160p_5s', 'size': '3840x2160', 'duration': 5},
+  {'name': 'yuv444_1080p_5s', 'size': '1920x1080', 'duration': 5, 'pix_fmt': 'yuv444p', 'quick': True},
+  {'name': 'no_audio_720p_5s', 'size': '1280x720', 'duration': 5, 'audio': False},
+  {'name': 'av1_720p_5s', 'size': '1280x720', 'duration': 5, 'codec': 'av1', 'quick': True},
+  {'name': 'truncated_moov_720p', 'size': '1280x720', 'duration': 5, 'corrupt': 'missing_moov', 'quick': True},
+  {'name': 'truncated_mdat_720p', 'size': '1280x720', 'duration': 5, 'corrupt': 'truncated_mdat'},
+  {'name': 'stco_corrupt_720p', 'size': '1280x720', 'duration': 5, 'corrupt': 'stco', 'quick': True},
+  {'name': 'stsc_corrupt_720p', 'size': '1280x720', 'duration': 5, 'corrupt': 'stsc'},
+  # Noise doesn't compress, so this lands over the Cloudinary cap and
+  # exercises the size-target and GCS paths
+  {'name': 'noise_1080p_60s', 'size': '1920x1080', 'duration': 60, 'source': 'noise', 'large': True},
+]
+
+AV1_ENCODERS = (
+  ('libsvtav1', ['-preset', '12']),
+  ('libaom-av1', ['-cpu-used', '8', '-row-mt', '1']),
+  ('librav1e', ['-speed', '10']),
+)
+
+def ffmpeg_encoders(ffmpeg_bin):
+  result = subprocess.run([ffmpeg_bin, '-hide_banner', '-encoders'], capture_output=True, text=True)
+  return set(re.findall(r'^\s*[VAS][\w.]{5}\s+(\S+)', result.stdout, re.MULTILINE))
+
+def ffmpeg_version(ffmpeg_bin):
+  try:
+    result = subprocess.run([ffmpeg_bin, '-version'], capture_output=True, text=True)
+    return result.stdout.splitlines()[0] if result.stdout else None
+  except OSError:
+    return None
+
+def find_box(data, box_type, start=0):
+  """
+  Returns the offset of the first box of box_type at or after start (by
+  scanning for its fourcc), or -1.
+  """
+  offset = data.find(box_type, start)
+  return offset - 4 if offset >= 4 else -1
+
+def corrupt_stco(data):
+  """
+  Points every chunk offset in the first stco box past the end of the file.
+  """
+  box = find_box(data, b'stco')
+  if box < 0:
+    raise ValueError('no stco box to corrupt')
+  entry_count = struct.unpack('>I', data[box + 12:box + 16])[0]
+  for i in range(entry_count):
+    entry = box + 16 + 4 * i
+    data[entry:entry + 4] = struct.pack('>I', 0xFFFFFF00 - i)
+  return data
+
+def corrupt_stsc(data):
+  """
+  Makes the first stsc box claim far more samples per chunk than exist and
+  its chunk runs out of order.
+  """
+  box = find_box(data, b'stsc')
+  if box < 0:
+    raise ValueError('no stsc box to corrupt')
+  entry_count = struct.unpack('>I', data[box + 12:box + 16])[0]
+  for i in range(entry_count):
+    entry = box + 16 + 12 * i
+    data[entry:entry + 8] = struct.pack('>II', entry_count - i + 1, 0x7FFFFFFF)
+  return data
+
+def build_input(case, ffmpeg_bin, encoders, output_dir):
+  """
+  Generates the input file for case into output_dir and returns its path,
+  or raises RuntimeError if this ffmpeg build can't produce it.
+  """
+  path = os.path.join(output_dir, case['name'] + '.mp4')
+  if os.path.exists(path):
+    return path
+  duration = case['duration']
+  if case.get('source') == 'noise':
+    video_source = f"nullsrc=size={case['size']}:rate=30:duration={duration},geq=random(1)*255:128:128"
+  else:
+    video_source = f"testsrc2=size={case['size']}:rate=30:duration={duration}"
+  cmd = [ffmpeg_bin, '-y', '-hide_banner', '-loglevel', 'error', '-f', 'lavfi', '-i', video_source]
+  if case.get('audio', True):
+    cmd += ['-f', 'lavfi', '-i', f"sine=frequency=440:sample_rate=48000:duration={duration}"]
+  if case.get('codec') == 'av1':
+    encoder = next(((name, args) for name, args in AV1_ENCODERS if name in encoders), None)
+    if encoder is None:
+      raise RuntimeError('no AV1 encoder in this ffmpeg build')
+    cmd += ['-c:v', encoder[0]] + encoder[1] + ['-pix_fmt', 'yuv420p']
+  elif case.get('source') == 'noise':
+    cmd += ['-c:v', 'libx264', '-preset', 'ultrafast', '-qp', '0', '-pix_fmt', 'yuv420p']
+  else:
+    cmd += ['-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', case.get('pix_fmt', 'yuv420p')]
+  if case.get('audio', True):
+    cmd += ['-c:a', 'aac', '-b:a', '128k', '-shortest']
+  # missing_moov needs the moov at the tail so truncation removes it; the
+  # others want it up front so the index survives and the payload doesn't
+  if case.get('corrupt') != 'missing_moov':
+    cmd += ['-movflags', '+faststart']
+  tmp_path = path + '.tmp.mp4'
+  cmd += BITEXACT_ARGS + [tmp_path]
+  result = subprocess.run(cmd, capture_output=True, text=True)
+  if result.returncode != 0:
+    raise RuntimeError(f"ffmpeg could not build {case['name']}: {result.stderr.strip()[-500:]}")
+
+  corrupt = case.get('corrupt')
+  if corrupt in ('missing_moov', 'truncated_mdat'):
+    # A download cut off at 60%: with the moov at the tail it's gone, with
+    # faststart the index survives but points at missing payload
+    os.truncate(tmp_path, int(os.path.getsize(tmp_path) * 0.6))
+  elif corrupt in ('stco', 'stsc'):
+    with open(tmp_path, 'rb') as f:
+      data = bytearray(f.read())
+    data = corrupt_stco(data) if corrupt == 'stco' else corrupt_stsc(data)
+    with open(tmp_path, 'wb') as f:
+      f.write(data)
+  os.replace(tmp_path, path)
+  return path
+
+class StandInServer(ThreadingHTTPServer):
+  """
+  One local HTTP server standing in for both Cloudinary's upload API
+  (CLOUDINARY_UPLOAD_PREFIX) and the GCS JSON API (STORAGE_EMULATOR_HOST).
+  Uploads are counted and discarded.
+  """
+  daemon_threads = True
+
+  def __init__(self):
+    super().__init__(('127.0.0.1', 0), StandInHandler)
+    self.lock = threading.Lock()
+    self.sessions = {}  # GCS session id -> bytes received
+    self.uploads = {}   # Cloudinary upload id -> bytes received
+    self.bytes_received = 0
+    self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+  @property
+  def url(self):
+    return f"http://127.0.0.1:{self.server_port}"
+
+  def __enter__(self):
+    self.thread.start()
+    return self
+
+  def __exit__(self, *exc):
+    self.shutdown()
+    self.server_close()
+
+class StandInHandler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  def log_message(self, *args):
+    pass
+
+  def _read_body(self):
+    length = int(self.headers.get('Content-Length') or 0)
+    remaining = length
+    while remaining:
+      chunk = self.rfile.read(min(remaining, 1024 * 1024))
+      if not chunk:
+        break
+      remaining -= len(chunk)
+    with self.server.lock:
+      self.server.bytes_received += length - remaining
+    return length - remaining
+
+  def _reply(self, status, body=None, headers=None):
+    payload = json.dumps(body).encode() if body is not None else b''
+    self.send_response(status)
+    for key, value in (headers or {}).items():
+      self.send_header(key, value)
+    if body is not None:
+      self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(payload)))
+    self.end_headers()
+    self.wfile.write(payload)
+
+  def do_HEAD(self):
+    # destination_exists() probes stored URLs; nothing outlives a run here
+    self._reply(404)
+
+  def do_POST(self):
+    parsed = urlparse(self.path)
+    received = self._read_body()
+    if parsed.path.startswith('/upload/storage/v1/b/'):
+      # GCS: start a resumable session
+      bucket = parsed.path.split('/')[5]
+      name = parse_qs(parsed.query).get('name', ['object'])[0]
+      with self.server.lock:
+        session_id = str(len(self.server.sessions) + 1)
+        self.server.sessions[session_id] = 0
+      location = f"{self.server.url}/upload/storage/v1/b/{bucket}/o?uploadType=resumable&upload_id={session_id}&name={name}"
+      self._reply(200, {}, {'Location': location})
+      return
+    # Cloudinary: /v1_1/<cloud>/<resource_type>/upload, chunked by Content-Range
+    resource_type = parsed.path.rstrip('/').split('/')[-2] if parsed.path.count('/') >= 3 else 'image'
+    upload_id = self.headers.get('X-Unique-Upload-Id') or uuid.uuid4().hex
+    content_range = self.headers.get('Content-Range')
+    with self.server.lock:
+      total_received = self.server.uploads.get(upload_id, 0) + received
+      self.server.uploads[upload_id] = total_received
+    public_id = f"bench/{upload_id[:16]}"
+    body = {'public_id': public_id, 'resource_type': resource_type,
+            'secure_url': f"https://res.cloudinary.invalid/{resource_type}/upload/{public_id}",
+            'bytes': total_received}
+    if content_range:
+      match = re.match(r'bytes (\d+)-(\d+)/(\d+)', content_range)
+      if match and int(match.group(2)) + 1 < int(match.group(3)):
+        body = {'public_id': public_id, 'done': False}
+    self._reply(200, body)
+
+  def do_PUT(self):
+    # GCS: one chunk of a resumable session
+    parsed = urlparse(self.path)
+    session_id = parse_qs(parsed.query).get('upload_id', [''])[0]
+    received = self._read_body()
+    with self.server.lock:
+      stored = self.server.sessions.get(session_id, 0) + received
+      self.server.sessions[session_id] = stored
+    match = re.match(r'bytes (?:\d+-\d+|\*)/(\d+|\*)', self.headers.get('Content-Range') or '')
+    total = match.group(1) if match else '*'
+    if total != '*' and stored >= int(total):
+      self._reply(200, {'name': parse_qs(parsed.query).get('name', [''])[0], 'size': str(stored)})
+    else:
+      self._reply(308, None, {'Range': f"bytes=0-{stored - 1}"} if stored else {})
+
+def helper_env(server_url, run_dir, extra_env):
+  """
+  Environment for one helper run: credentials and endpoints for the local
+  stand-ins, a fresh cache DB (cold probe cache, no dedup) and a trace file.
+  """
+  env = dict(os.environ)
+  env.update({
+    'CLOUDINARY_CLOUD_NAME': 'bench',
+    'CLOUDINARY_API_KEY': 'bench',
+    'CLOUDINARY_API_SECRET': 'bench',
+    'CLOUDINARY_UPLOAD_PREFIX': server_url,
+    'STORAGE_EMULATOR_HOST': server_url,
+    'GOOGLE_CLOUD_PROJECT': 'bench',
+    # Large outputs go to the GCS stand-in rather than public/videos
+    'NODE_ENV': 'production',
+    'VIDEO_CDN_DEDUP': '0',
+    'VIDEO_CDN_CACHE_DB': os.path.join(run_dir, 'cache.sqlite3'),
+    'VIDEO_CDN_TRACE_FILE': os.path.join(run_dir, 'trace.jsonl'),
+  })
+  env.pop('VIDEO_CDN_METRICS_FILE', None)
+  env.update(extra_env)
+  return env
+
+def run_case(case, input_path, server, work_dir, run_index, extra_env, timeout):
+  """
+  Runs the helper on a private copy of input_path and returns its record.
+  CPU time and peak RSS come from wait4(), so they include ffmpeg and
+  ffprobe; on Linux ru_maxrss is the largest single process in that tree
+  (in practice the biggest ffmpeg), not their sum.
+  """
+  run_dir = tempfile.mkdtemp(prefix=f"{case['name']}.{run_index}.", dir=work_dir)
+  local_path = os.path.join(run_dir, os.path.basename(input_path))
+  shutil.copyfile(input_path, local_path)
+  env = helper_env(server.url, run_dir, extra_env)
+  stdout_path = os.path.join(run_dir, 'stdout.txt')
+  stderr_path = os.path.join(run_dir, 'stderr.txt')
+  started = time.perf_counter()
+  with open(stdout_path, 'wb') as stdout, open(stderr_path, 'wb') as stderr:
+    proc = subprocess.Popen([sys.executable, HELPER_PATH, '--json', local_path], env=env,
+                            stdin=subprocess.DEVNULL, stdout=stdout, stderr=stderr)
+    timer = threading.Timer(timeout, proc.kill)
+    timer.start()
+    try:
+      _, status, usage = os.wait4(proc.pid, 0)
+    finally:
+      timer.cancel()
+    proc.returncode = os.waitstatus_to_exitcode(status)
+  wall = time.perf_counter() - started
+
+  with open(stdout_path, 'r', errors='replace') as f:
+    lines = [line for line in f.read().splitlines() if line.strip()]
+  try:
+    result = json.loads(lines[-1]) if lines else {}
+  except ValueError:
+    result = {}
+  trace = {}
+  trace_path = env['VIDEO_CDN_TRACE_FILE']
+  if os.path.exists(trace_path):
+    with open(trace_path) as f:
+      trace = json.loads(f.read().splitlines()[-1])
+  error = None
+  if proc.returncode != 0:
+    with open(stderr_path, 'r', errors='replace') as f:
+      error_lines = [line for line in f.read().splitlines() if line.startswith('Error: ')]
+    error = error_lines[-1][len('Error: '):] if error_lines else trace.get('error')
+
+  if trace.get('dedup_hit'):
+    branch = 'dedup'
+  elif trace.get('encode_path') == 'remux':
+    branch = 'remux'
+  else:
+    branch = trace.get('strategy') or trace.get('encode_path') or ('failed' if error else None)
+  record = {
+    'case': case['name'],
+    'run': run_index,
+    'exit_code': proc.returncode,
+    'ok': proc.returncode == 0,
+    'error': error,
+    'wall_seconds': round(wall, 4),
+    'cpu_seconds': round(usage.ru_utime + usage.ru_stime, 4),
+    'peak_rss_kb': usage.ru_maxrss,
+    'input_bytes': os.path.getsize(input_path),
+    'output_bytes': trace.get('bytes_out'),
+    'branch': branch,
+    'encode_path': trace.get('encode_path'),
+    'strategies_tried': trace.get('strategies_tried', []),
+    'destination': trace.get('destination') or result.get('destination'),
+    'upload_retries': trace.get('upload_retries', 0),
+    'timings': trace.get('timings', {}),
+  }
+  return record, run_dir
+
+def median(values):
+  values = sorted(values)
+  if not values:
+    return None
+  middle = len(values) // 2
+  return values[middle] if len(values) % 2 else (values[middle - 1] + values[middle]) / 2
+
+def summarize(records):
+  """
+  Collapses repeated runs to one row per case (medians for the numbers).
+  """
+  by_case = {}
+  for record in records:
+    if 'case' in record:
+      by_case.setdefault(record['case'], []).append(record)
+  summary = {}
+  for name, runs in by_case.items():
+    summary[name] = {
+      'runs': len(runs),
+      'ok': sum(1 for run in runs if run['ok']),
+      'wall_seconds': median([run['wall_seconds'] for run in runs]),
+      'cpu_seconds': median([run['cpu_seconds'] for run in runs]),
+      'peak_rss_kb': median([run['peak_rss_kb'] for run in runs]),
+      'output_bytes': median([run['output_bytes'] for run in runs if run['output_bytes'] is not None]),
+      'branch': sorted({run['branch'] or '-' for run in runs}),
+    }
+  return summary
+
+def load_records(path):
+  with open(path) as f:
+    return [json.loads(line) for line in f if line.strip()]
+
+def _delta(new, old):
+  if new is None or not old:
+    return ''
+  return f" ({(new - old) / old * 100:+.1f}%)"
+
+def print_summary(summary, baseline=None, out=sys.stdout):
+  header = f"{'case':<22} {'ok':>5} {'wall s':>16} {'cpu s':>16} {'rss MB':>16} {'out MB':>16}  branch"
+  print(header, file=out)
+  print('-' * len(header), file=out)
+  for name, row in summary.items():
+    old = (baseline or {}).get(name, {})
+    def cell(key, scale=1.0, digits=2):
+      value = row[key]
+      if value is None:
+        return '-'
+      old_value = old.get(key)
+      return f"{value / scale:.{digits}f}{_delta(value, old_value)}"
+    branch = ','.join(row['branch'])
+    if old and old.get('branch') != row['branch']:
+      branch += f" (was {','.join(old.get('branch') or [])})"
+    print(f"{name:<22} {row['ok']:>2}/{row['runs']:<2} {cell('wall_seconds'):>16} {cell('cpu_seconds'):>16} "
+          f"{cell('peak_rss_kb', 1024, 1):>16} {cell('output_bytes', 1024 * 1024, 2):>16}  {branch}", file=out)
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description='Benchmark video_cdn_helper.py on synthetic media.')
+  parser.add_argument('--quick', action='store_true', help='run the small subset of cases')
+  parser.add_argument('--large', action='store_true', help='also run cases whose output exceeds the Cloudinary cap')
+  parser.add_argument('--cases', help='comma-separated case names (overrides --quick/--large)')
+  parser.add_argument('--repeat', type=int, default=1, help='runs per case (medians are reported)')
+  parser.add_argument('--out', help='append JSON-lines records here')
+  parser.add_argument('--baseline', help='records from an earlier run to compare against')
+  parser.add_argument('--inputs', help='directory to cache generated inputs in (reused across runs)')
+  parser.add_argument('--ffmpeg', default=FFMPEG_BIN, help='ffmpeg used to build inputs')
+  parser.add_argument('--timeout', type=float, default=1800, help='seconds before a helper run is killed')
+  parser.add_argument('--keep', action='store_true', help="keep each run's directory (stderr, trace, outputs)")
+  parser.add_argument('--env', action='append', default=[], metavar='KEY=VALUE',
+                      help='extra environment for the helper, e.g. VIDEO_CDN_STREAMING=1')
+  parser.add_argument('--list', action='store_true', help='list the cases and exit')
+  return parser.parse_args(argv)
+
+def select_cases(args):
+  if args.cases:
+    wanted = args.cases.split(',')
+    unknown = set(wanted) - {case['name'] for case in CASES}
+    if unknown:
+      raise SystemExit(f"Unknown case(s): {', '.join(sorted(unknown))}")
+    return [case for case in CASES if case['name'] in wanted]
+  return [case for case in CASES
+          if (not args.quick or case.get('quick')) and (args.large or not case.get('large'))]
+
+def main(argv):
+  args = parse_args(argv)
+  cases = select_cases(args)
+  if args.list:
+    for case in CASES:
+      tags = [tag for tag in ('quick', 'large') if case.get(tag)]
+      print(f"{case['name']:<22} {' '.join(tags)}")
+    return 0
+  extra_env = dict(item.split('=', 1) for item in args.env)
+  ffmpeg_bin = os.path.abspath(args.ffmpeg)
+  encoders = ffmpeg_encoders(ffmpeg_bin)
+
+  work_dir = tempfile.mkdtemp(prefix='video_cdn_bench.')
+  inputs_dir = args.inputs or os.path.join(work_dir, 'inputs')
+  os.makedirs(inputs_dir, exist_ok=True)
+  header = {
+    'bench': 'video_cdn_helper', 'ts': time.time(), 'python': platform.python_version(),
+    'platform': platform.platform(), 'cpus': os.cpu_count(), 'ffmpeg': ffmpeg_version(ffmpeg_bin),
+    'repeat': args.repeat, 'env': extra_env,
+  }
+  records = []
+  out = open(args.out, 'a') if args.out else None
+  try:
+    if out:
+      out.write(json.dumps(header) + '\n')
+    with StandInServer() as server:
+      for case in cases:
+        try:
+          input_path = build_input(case, ffmpeg_bin, encoders, inputs_dir)
+        except (RuntimeError, ValueError) as e:
+          print(f"[BENCH] Skipping {case['name']}: {e}", file=sys.stderr)
+          continue
+        for run_index in range(args.repeat):
+          record, run_dir = run_case(case, input_path, server, work_dir, run_index, extra_env, args.timeout)
+          records.append(record)
+          print(f"[BENCH] {record['case']} #{run_index}: exit {record['exit_code']}, {record['wall_seconds']:.2f}s wall, "
+                f"{record['cpu_seconds']:.2f}s cpu, branch {record['branch']}", file=sys.stderr)
+          if out:
+            out.write(json.dumps(record) + '\n')
+            out.flush()
+          if not args.keep:
+            shutil.rmtree(run_dir, ignore_errors=True)
+  finally:
+    if out:
+      out.close()
+    if args.keep:
+      print(f"[BENCH] Run directories kept in {work_dir}", file=sys.stderr)
+    else:
+      shutil.rmtree(work_dir, ignore_errors=True)
+
+  baseline = summarize(load_records(args.baseline)) if args.baseline else None
+  print_summary(summarize(records), baseline)
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main(sys.argv[1:]))
@@ -1,8 +1,20 @@
 import os
+import sys
+import json
+import time
+import socket
+import stat
+import sqlite3
+import uuid
+import shutil
+import hashlib
+import tempfile
+import threading
 import subprocess
-import cloudinary
-import cloudinary.uploader
-from google.cloud import storage
+import urllib.error
+from collections import deque
+from contextlib import closing, contextmanager
+from dataclasses import dataclass, asdict, field
 
 # Load .env file if it exists (fallback for when env vars aren't passed from Node.js)
 def load_env_file():
@@ -18,26 +30,1697 @@ def load_env_file():
                         if key not in os.environ:
                             os.environ[key] = value.strip('"\'')
         except Exception as e:
-            import sys
             print(f"[DEBUG] Could not load .env file: {e}", file=sys.stderr)
 
-# Load environment variables
+_env_load_started = time.perf_counter()
+
+# Load environment variables (the storage SDKs are imported and configured
+# later, by the backend that a job is actually routed to)
 load_env_file()
 
-# Configure Cloudinary
-cloudinary.config(
-    cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
-    api_key=os.getenv('CLOUDINARY_API_KEY'),
-    api_secret=os.getenv('CLOUDINARY_API_SECRET')
-)
+# Reported in the trace of the first job this process runs
+_env_load_seconds = time.perf_counter() - _env_load_started
+
+CACHE_DB_PATH = os.getenv('VIDEO_CDN_CACHE_DB') or os.path.join(os.path.dirname(__file__), '.video_cdn_cache.sqlite3')
+PARTIAL_HASH_BYTES = 1024 * 1024  # Hash this much from the head and the tail of a file
+
+def open_cache_db():
+  """
+  Opens the helper's local SQLite cache (shared by every worker process).
+  """
+  conn = sqlite3.connect(CACHE_DB_PATH, timeout=30)
+  conn.execute('CREATE TABLE IF NOT EXISTS probe_cache (fingerprint TEXT PRIMARY KEY, info TEXT NOT NULL)')
+  conn.execute('CREATE TABLE IF NOT EXISTS content_hashes (fingerprint TEXT PRIMARY KEY, content_hash TEXT NOT NULL)')
+  conn.execute('CREATE TABLE IF NOT EXISTS dedup_index ('
+               'content_hash TEXT NOT NULL, settings TEXT NOT NULL, url TEXT NOT NULL, result TEXT, created_at REAL NOT NULL, '
+               'PRIMARY KEY (content_hash, settings))')
+  return conn
+
+def file_fingerprint(path):
+  """
+  Cheap identity for a file: size, mtime and a hash of its first and last
+  PARTIAL_HASH_BYTES. Changes whenever the file is replaced or rewritten.
+  """
+  stat = os.stat(path)
+  digest = hashlib.sha1()
+  with open(path, 'rb') as f:
+    digest.update(f.read(PARTIAL_HASH_BYTES))
+    if stat.st_size > PARTIAL_HASH_BYTES:
+      f.seek(max(PARTIAL_HASH_BYTES, stat.st_size - PARTIAL_HASH_BYTES))
+      digest.update(f.read(PARTIAL_HASH_BYTES))
+  return f"{stat.st_size}:{stat.st_mtime_ns}:{digest.hexdigest()}"
+
+@dataclass
+class MediaInfo:
+  """
+  Everything the helper needs to know about an input, from one ffprobe pass.
+  """
+  ok: bool
+  error: str = ''
+  container: str = ''
+  duration: float = 0.0
+  bit_rate: int = 0
+  video_codec: str = ''
+  pix_fmt: str = ''
+  width: int = 0
+  height: int = 0
+  frame_rate: float = 0.0
+  rotation: int = 0
+  video_bit_rate: int = 0
+  audio_codec: str = ''
+  audio_channels: int = 0
+  channel_layout: str = ''
+  sample_rate: int = 0
+
+  @property
+  def has_video(self):
+    return bool(self.video_codec)
+
+  @property
+  def has_audio(self):
+    return bool(self.audio_codec)
+
+  @property
+  def display_size(self):
+    """
+    (width, height) as the video is shown, i.e. after applying rotation.
+    """
+    if self.rotation % 180 == 90:
+      return self.height, self.width
+    return self.width, self.height
+
+def _to_int(value):
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return 0
+
+def _to_float(value):
+  try:
+    return float(value)
+  except (TypeError, ValueError):
+    return 0.0
+
+def _parse_rate(value):
+  """
+  Parses an ffprobe rational such as '30000/1001' into a float.
+  """
+  num, _, den = (value or '').partition('/')
+  if not den:
+    return _to_float(num)
+  return _to_float(num) / _to_float(den) if _to_float(den) else 0.0
+
+def _parse_rotation(stream):
+  for side_data in stream.get('side_data_list') or []:
+    if 'rotation' in side_data:
+      return _to_int(side_data['rotation']) % 360
+  return _to_int((stream.get('tags') or {}).get('rotate')) % 360
+
+def parse_ffprobe_json(data):
+  """
+  Builds a MediaInfo from `ffprobe -of json -show_format -show_streams` output.
+  """
+  fmt = data.get('format') or {}
+  streams = data.get('streams') or []
+  video = next((st for st in streams if st.get('codec_type') == 'video'), {})
+  audio = next((st for st in streams if st.get('codec_type') == 'audio'), {})
+  duration = _to_float(fmt.get('duration')) or _to_float(video.get('duration')) or _to_float(audio.get('duration'))
+  return MediaInfo(
+    ok=True,
+    container=fmt.get('format_name', ''),
+    duration=duration,
+    bit_rate=_to_int(fmt.get('bit_rate')),
+    video_codec=video.get('codec_name', ''),
+    pix_fmt=video.get('pix_fmt', ''),
+    width=_to_int(video.get('width')),
+    height=_to_int(video.get('height')),
+    frame_rate=_parse_rate(video.get('avg_frame_rate')) or _parse_rate(video.get('r_frame_rate')),
+    rotation=_parse_rotation(video),
+    video_bit_rate=_to_int(video.get('bit_rate')),
+    audio_codec=audio.get('codec_name', ''),
+    audio_channels=_to_int(audio.get('channels')),
+    channel_layout=audio.get('channel_layout', ''),
+    sample_rate=_to_int(audio.get('sample_rate')),
+  )
+
+def _read_cached_probe(fingerprint):
+  try:
+    with closing(open_cache_db()) as conn:
+      row = conn.execute('SELECT info FROM probe_cache WHERE fingerprint = ?', (fingerprint,)).fetchone()
+    return MediaInfo(**json.loads(row[0])) if row else None
+  except (sqlite3.Error, ValueError, TypeError) as e:
+    print(f"[DEBUG] Probe cache read skipped: {e}", file=sys.stderr)
+    return None
+
+def _write_cached_probe(fingerprint, info):
+  try:
+    with closing(open_cache_db()) as conn, conn:
+      conn.execute('INSERT OR REPLACE INTO probe_cache (fingerprint, info) VALUES (?, ?)', (fingerprint, json.dumps(asdict(info))))
+  except sqlite3.Error as e:
+    print(f"[DEBUG] Probe cache write skipped: {e}", file=sys.stderr)
+
+def probe_media(path, ffprobe_bin):
+  """
+  Runs a single JSON ffprobe pass over path and returns a MediaInfo, or None
+  when ffprobe is unavailable. Results (including failed probes) are cached
+  by file fingerprint, so retries and repeated batch runs never re-probe.
+  """
+  fingerprint = file_fingerprint(path)
+  cached = _read_cached_probe(fingerprint)
+  if cached is not None:
+    print(f"[DEBUG] Using cached probe result for {path}", file=sys.stderr)
+    return cached
+  if not os.path.exists(ffprobe_bin):
+    return None
+  probe_cmd = [ffprobe_bin, '-v', 'error', '-of', 'json', '-show_format', '-show_streams', path]
+  try:
+    probe_result = subprocess.run(probe_cmd, capture_output=True, text=True, timeout=10)
+  except (subprocess.TimeoutExpired, FileNotFoundError, PermissionError) as e:
+    # Not cached: a timeout says more about the box than the file
+    print(f"[DEBUG] ffprobe validation skipped ({type(e).__name__}: {e})", file=sys.stderr)
+    return None
+  if probe_result.returncode != 0:
+    info = MediaInfo(ok=False, error=probe_result.stderr.strip())
+  else:
+    try:
+      info = parse_ffprobe_json(json.loads(probe_result.stdout or '{}'))
+    except ValueError as e:
+      info = MediaInfo(ok=False, error=f"Unreadable ffprobe output: {e}")
+  _write_cached_probe(fingerprint, info)
+  return info
+
+# Pre-flight structure check for MP4/MOV (ISO BMFF). Top-level boxes are
+# walked with seeks, so only their 8-16 byte headers are read; the one
+# payload read is moov itself (sample tables, bounded by
+# MOOV_SCAN_MAX_BYTES), never mdat.
+MP4_TOP_LEVEL_BOXES = {b'ftyp', b'moov', b'mdat', b'free', b'skip', b'wide', b'uuid', b'pdin', b'meta',
+                       b'moof', b'mfra', b'styp', b'sidx', b'ssix', b'prft', b'emsg', b'pnot', b'PICT'}
+MP4_SAMPLE_TABLE_PARENTS = {b'moov', b'trak', b'mdia', b'minf', b'stbl'}
+MOOV_SCAN_MAX_BYTES = 64 * 1024 * 1024
+MAX_TOP_LEVEL_BOXES = 100_000
+MAX_PADDING_BYTES = 1024 * 1024  # Longer zero runs look like a lost payload, not padding
+
+@dataclass
+class ContainerScan:
+  """
+  What the top-level box walk found. problems holds one line per issue;
+  the flags say which kind of damage it is.
+  """
+  is_mp4: bool = False
+  leading_box: str = ''
+  file_size: int = 0
+  boxes: list = field(default_factory=list)  # [(type, offset, size)] of the top-level boxes
+  moov_offset: int = -1
+  mdat_offset: int = -1
+  truncated: bool = False
+  bad_sizes: bool = False
+  bad_sample_tables: bool = False
+  problems: list = field(default_factory=list)
+  padding_bytes: int = 0  # Zero bytes after the last box; harmless, not a problem
+  scan_seconds: float = 0.0
+
+  @property
+  def has_moov(self):
+    return self.moov_offset >= 0
+
+  @property
+  def missing_moov(self):
+    return self.is_mp4 and not self.has_moov
+
+  @property
+  def moov_at_end(self):
+    """
+    True if moov follows mdat (not faststart): fine for ffmpeg, but the
+    whole file has to be there before anything can be decoded.
+    """
+    return self.has_moov and 0 <= self.mdat_offset < self.moov_offset
+
+  def summary(self):
+    return {'boxes': ','.join(box_type for box_type, _, _ in self.boxes), 'moov_at_end': self.moov_at_end,
+            'problems': list(self.problems), 'padding_bytes': self.padding_bytes, 'scan_seconds': self.scan_seconds}
+
+def _fourcc(raw):
+  return raw.decode('latin-1')
+
+def _is_fourcc(raw):
+  return len(raw) == 4 and all(32 <= byte < 127 or byte == 0xa9 for byte in raw)
+
+def _check_sample_table(stbl, file_size, problems):
+  """
+  Checks one stbl payload: chunk offsets must lie inside the file and the
+  stsc runs must start at chunk 1, ascend, and not reference more chunks
+  than stco/co64 lists. Returns False if anything is off.
+  """
+  ok = True
+  chunk_count = None
+  stsc_entries = None
+  children, error = _child_boxes(stbl)
+  if error:
+    problems.append(error)
+    ok = False
+  for box_type, payload in children:
+    if box_type in (b'stco', b'co64') and len(payload) >= 8:
+      entry_size = 4 if box_type == b'stco' else 8
+      entry_count = int.from_bytes(payload[4:8], 'big')
+      if 8 + entry_count * entry_size > len(payload):
+        problems.append(f"{_fourcc(box_type)} lists {entry_count} chunks but only has room for {(len(payload) - 8) // entry_size}")
+        ok = False
+        continue
+      chunk_count = entry_count
+      if entry_count:
+        table = payload[8:8 + entry_count * entry_size]
+        last_offset = max(int.from_bytes(table[i:i + entry_size], 'big') for i in range(0, len(table), entry_size))
+        if last_offset >= file_size:
+          problems.append(f"{_fourcc(box_type)} chunk offset {last_offset} is past the end of the file ({file_size} bytes)")
+          ok = False
+    elif box_type == b'stsc' and len(payload) >= 8:
+      entry_count = int.from_bytes(payload[4:8], 'big')
+      if 8 + entry_count * 12 > len(payload):
+        problems.append(f"stsc lists {entry_count} entries but only has room for {(len(payload) - 8) // 12}")
+        ok = False
+        continue
+      stsc_entries = [(int.from_bytes(payload[8 + i * 12:12 + i * 12], 'big'),
+                       int.from_bytes(payload[12 + i * 12:16 + i * 12], 'big')) for i in range(entry_count)]
+  if stsc_entries:
+    first_chunks = [first_chunk for first_chunk, _ in stsc_entries]
+    if first_chunks[0] != 1 or any(b <= a for a, b in zip(first_chunks, first_chunks[1:])):
+      problems.append('stsc chunk runs do not start at 1 and ascend')
+      ok = False
+    elif chunk_count is not None and first_chunks[-1] > chunk_count:
+      problems.append(f"stsc references chunk {first_chunks[-1]} but the chunk offset table has {chunk_count}")
+      ok = False
+    if any(samples == 0 for _, samples in stsc_entries):
+      problems.append('stsc has a run with zero samples per chunk')
+      ok = False
+  return ok
+
+def _child_boxes(payload):
+  """
+  Splits payload into its (type, payload) boxes. Returns (boxes, error);
+  error describes the first box whose size doesn't fit, which ends the list.
+  """
+  boxes = []
+  offset = 0
+  while offset + 8 <= len(payload):
+    size = int.from_bytes(payload[offset:offset + 4], 'big')
+    box_type = bytes(payload[offset + 4:offset + 8])
+    header_size = 8
+    if size == 1 and offset + 16 <= len(payload):
+      size = int.from_bytes(payload[offset + 8:offset + 16], 'big')
+      header_size = 16
+    elif size == 0:
+      size = len(payload) - offset
+    if size < header_size or offset + size > len(payload):
+      return boxes, f"'{_fourcc(box_type)}' box at moov offset {offset} claims {size} bytes, beyond its parent"
+    boxes.append((box_type, payload[offset + header_size:offset + size]))
+    offset += size
+  return boxes, None
+
+def _check_moov(moov, file_size, problems):
+  """
+  Walks moov down to each track's stbl. Returns (sizes_ok, tables_ok).
+  """
+  sizes_ok = tables_ok = True
+  pending = [moov]
+  while pending:
+    children, error = _child_boxes(pending.pop())
+    if error:
+      problems.append(error)
+      sizes_ok = False
+    for box_type, payload in children:
+      if box_type == b'stbl':
+        tables_ok = _check_sample_table(payload, file_size, problems) and tables_ok
+      elif box_type in MP4_SAMPLE_TABLE_PARENTS:
+        pending.append(payload)
+  return sizes_ok, tables_ok
+
+def _is_zero_padding(f, offset, file_size):
+  """
+  True if everything from offset to the end of the file is zero bytes
+  (some writers and download tools pad files), up to MAX_PADDING_BYTES.
+  """
+  if file_size - offset > MAX_PADDING_BYTES:
+    return False
+  f.seek(offset)
+  return not f.read(file_size - offset).strip(b'\x00')
+
+def scan_container(path):
+  """
+  Walks the top-level boxes of an MP4/MOV and reports truncation, a missing
+  or trailing moov, box sizes that don't add up, and sample tables that
+  point outside the file, without decoding anything. Non-MP4 inputs come
+  back with is_mp4=False and nothing else checked.
+  """
+  started = time.perf_counter()
+  scan = ContainerScan(file_size=os.path.getsize(path))
+  with open(path, 'rb') as f:
+    offset = 0
+    while offset < scan.file_size and len(scan.boxes) < MAX_TOP_LEVEL_BOXES:
+      f.seek(offset)
+      header = f.read(16)
+      if scan.boxes and not header.strip(b'\x00') and _is_zero_padding(f, offset, scan.file_size):
+        scan.padding_bytes = scan.file_size - offset
+        break
+      if len(header) < 8:
+        scan.truncated = True
+        scan.problems.append(f"file ends inside a box header at offset {offset}")
+        break
+      size = int.from_bytes(header[:4], 'big')
+      box_type = header[4:8]
+      if not scan.boxes:
+        scan.leading_box = _fourcc(box_type) if _is_fourcc(box_type) else header[4:8].hex()
+        if box_type not in MP4_TOP_LEVEL_BOXES:
+          break
+        scan.is_mp4 = True
+      header_size = 8
+      if size == 1:
+        if len(header) < 16:
+          scan.truncated = True
+          scan.problems.append(f"file ends inside a 64-bit box header at offset {offset}")
+          break
+        size = int.from_bytes(header[8:16], 'big')
+        header_size = 16
+      elif size == 0:
+        size = scan.file_size - offset  # Box runs to the end of the file
+      if not _is_fourcc(box_type) or size < header_size:
+        scan.bad_sizes = True
+        scan.problems.append(f"invalid box at offset {offset} (type {header[4:8].hex()}, size {size}); "
+                             f"the previous box size is probably wrong")
+        break
+      scan.boxes.append((_fourcc(box_type), offset, size))
+      if box_type == b'moov' and scan.moov_offset < 0:
+        scan.moov_offset = offset
+        moov_payload = (offset + header_size, size - header_size)
+      elif box_type == b'mdat' and scan.mdat_offset < 0:
+        scan.mdat_offset = offset
+      if offset + size > scan.file_size:
+        scan.truncated = True
+        scan.problems.append(f"'{_fourcc(box_type)}' box at offset {offset} needs {size} bytes but only "
+                             f"{scan.file_size - offset} remain (truncated download?)")
+        if box_type == b'moov':
+          scan.moov_offset = -1  # An incomplete moov is as good as none
+        break
+      offset += size
+
+    if scan.has_moov:
+      payload_offset, payload_size = moov_payload
+      if payload_size <= MOOV_SCAN_MAX_BYTES:
+        f.seek(payload_offset)
+        sizes_ok, tables_ok = _check_moov(f.read(payload_size), scan.file_size, scan.problems)
+        scan.bad_sizes = scan.bad_sizes or not sizes_ok
+        scan.bad_sample_tables = not tables_ok
+    elif scan.is_mp4:
+      scan.problems.append('no moov box' + (' (fragmented MP4 without an init segment?)' if any(
+        box_type == 'moof' for box_type, _, _ in scan.boxes) else ''))
+  scan.scan_seconds = round(time.perf_counter() - started, 6)
+  return scan
+
+PUBLIC_VIDEOS_DIR = os.path.join(os.path.dirname(__file__), '../../public/videos')
+HASH_CHUNK_BYTES = 4 * 1024 * 1024
+CLOUDINARY_MAX_BYTES = 100 * 1024 * 1024  # 100MB in bytes
+
+# Remux-only fast path limits: inputs within these are copied, not re-encoded
+REMUX_MAX_BITRATE = int(os.getenv('VIDEO_CDN_REMUX_MAX_BITRATE') or 5_000_000)  # bits/s
+REMUX_MAX_LONG_SIDE = int(os.getenv('VIDEO_CDN_REMUX_MAX_LONG_SIDE') or 1920)
+REMUX_MAX_SHORT_SIDE = int(os.getenv('VIDEO_CDN_REMUX_MAX_SHORT_SIDE') or 1080)
+
+def is_web_ready(media, file_size, scan=None):
+  """
+  True if the input can be served as-is after a faststart remux: MP4/MOV
+  with H.264 yuv420p video, AAC (or no) audio, and bitrate, resolution and
+  size within the remux limits. A stream copy keeps whatever damage the
+  container scan found, so any scan problem rules it out.
+  """
+  if media is None or not media.ok:
+    return False
+  if scan is not None and scan.problems:
+    return False
+  if 'mp4' not in media.container and 'mov' not in media.container:
+    return False
+  if media.video_codec != 'h264' or media.pix_fmt != 'yuv420p':
+    return False
+  if media.audio_codec not in ('aac', ''):
+    return False
+  if not media.bit_rate or media.bit_rate > REMUX_MAX_BITRATE:
+    return False
+  long_side, short_side = max(media.width, media.height), min(media.width, media.height)
+  if not short_side or long_side > REMUX_MAX_LONG_SIDE or short_side > REMUX_MAX_SHORT_SIDE:
+    return False
+  return file_size <= CLOUDINARY_MAX_BYTES
+
+def encode_settings_key():
+  """
+  Identifies the encode settings an output was produced with. Part of the
+  dedup key so a settings change never serves an output made the old way
+  (or a URL from a forced backend, such as 'fake', to a normal run).
+  """
+  forced_backend = os.getenv('VIDEO_CDN_STORAGE_BACKEND')
+  # v2: results carry previews and Video metadata (thumbnail_url,
+  # preview_strip_url, width, height, duration); v1 entries have none.
+  # v3: long inputs may be segment-encoded, at or above seg= seconds.
+  return (f"libx264:crf28:aac:yuv420p:faststart:v3:"
+          f"remux<={REMUX_MAX_BITRATE}@{REMUX_MAX_LONG_SIDE}x{REMUX_MAX_SHORT_SIDE}"
+          f":seg={SEGMENTED_MIN_DURATION:g}"
+          f"{':stream' if streaming_enabled() else ''}:target={TARGET_SIZE_BYTES}"
+          f"{f':backend={forced_backend}' if forced_backend else ''}")
+
+def content_hash(path):
+  """
+  Streaming SHA-256 of the whole file. Memoised by file fingerprint so the
+  same untouched file is only read once.
+  """
+  fingerprint = file_fingerprint(path)
+  try:
+    with closing(open_cache_db()) as conn:
+      row = conn.execute('SELECT content_hash FROM content_hashes WHERE fingerprint = ?', (fingerprint,)).fetchone()
+    if row:
+      return row[0]
+  except sqlite3.Error as e:
+    print(f"[DEBUG] Content hash cache read skipped: {e}", file=sys.stderr)
+  digest = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for chunk in iter(lambda: f.read(HASH_CHUNK_BYTES), b''):
+      digest.update(chunk)
+  result = digest.hexdigest()
+  try:
+    with closing(open_cache_db()) as conn, conn:
+      conn.execute('INSERT OR REPLACE INTO content_hashes (fingerprint, content_hash) VALUES (?, ?)', (fingerprint, result))
+  except sqlite3.Error as e:
+    print(f"[DEBUG] Content hash cache write skipped: {e}", file=sys.stderr)
+  return result
+
+def destination_exists(url):
+  """
+  Checks whether a previously returned URL still points at something.
+  Only a definite answer (missing local file, HTTP 404/410) counts as gone;
+  network errors keep the entry so an outage doesn't flush the index.
+  """
+  import urllib.request
+  if url.startswith('/videos/'):
+    return os.path.isfile(os.path.join(PUBLIC_VIDEOS_DIR, os.path.basename(url)))
+  if url.startswith('file://'):
+    return os.path.isfile(url[len('file://'):])
+  try:
+    request = urllib.request.Request(url, method='HEAD')
+    with urllib.request.urlopen(request, timeout=5):
+      return True
+  except urllib.error.HTTPError as e:
+    return e.code not in (404, 410)
+  except (urllib.error.URLError, OSError, ValueError):
+    return True
+
+def lookup_dedup(digest, settings):
+  """
+  Returns the cached result dict for (digest, settings), evicting it if the
+  destination has disappeared.
+  """
+  try:
+    with closing(open_cache_db()) as conn:
+      row = conn.execute('SELECT url, result FROM dedup_index WHERE content_hash = ? AND settings = ?', (digest, settings)).fetchone()
+      if not row:
+        return None
+      if destination_exists(row[0]):
+        return {**json.loads(row[1] or '{}'), 'url': row[0]}
+      print(f"[DEBUG] Dedup entry is stale (destination gone), evicting: {row[0]}", file=sys.stderr)
+      with conn:
+        conn.execute('DELETE FROM dedup_index WHERE content_hash = ? AND settings = ?', (digest, settings))
+  except sqlite3.Error as e:
+    print(f"[DEBUG] Dedup lookup skipped: {e}", file=sys.stderr)
+  return None
+
+def record_dedup(digest, settings, result):
+  try:
+    with closing(open_cache_db()) as conn, conn:
+      conn.execute('INSERT OR REPLACE INTO dedup_index (content_hash, settings, url, result, created_at) VALUES (?, ?, ?, ?, ?)',
+                   (digest, settings, result['url'], json.dumps(result), time.time()))
+  except (sqlite3.Error, TypeError, ValueError) as e:
+    print(f"[DEBUG] Dedup record skipped: {e}", file=sys.stderr)
+
+def detect_environment():
+  """
+  Returns 'production' or the configured environment name. A production
+  database URL forces 'production' even if NODE_ENV says otherwise.
+  """
+  # Check environment - check multiple possible env vars and production indicators
+  env = os.getenv('NODE_ENV') or os.getenv('ENVIRONMENT') or os.getenv('ENV') or 'development'
+
+  # Also check for production indicators
+  database_url = os.getenv('DATABASE_URL', '')
+  is_prod_db = 'prisma.io' in database_url or 'postgres://' in database_url
+
+  print(f"[DEBUG] NODE_ENV from env: {os.getenv('NODE_ENV')}", file=sys.stderr)
+  print(f"[DEBUG] Environment detected: {env}", file=sys.stderr)
+  print(f"[DEBUG] Database URL contains production indicators: {is_prod_db}", file=sys.stderr)
+
+  # Force production if we detect production database
+  if is_prod_db and env != 'production':
+    env = 'production'
+    print(f"[DEBUG] Overriding environment to production based on database", file=sys.stderr)
+  return env
+
+@contextmanager
+def timed(report, stage):
+  """
+  Adds the wall time of the block to report['timings'][stage] (seconds,
+  accumulated if the stage runs more than once).
+  """
+  started = time.perf_counter()
+  try:
+    yield
+  finally:
+    timings = report.setdefault('timings', {})
+    timings[stage] = round(timings.get(stage, 0.0) + time.perf_counter() - started, 4)
+
+def count(stats, key, amount=1):
+  """
+  Bumps a counter in an optional stats/report dict.
+  """
+  if stats is not None:
+    stats[key] = stats.get(key, 0) + amount
+
+def _metric_labels(**labels):
+  return ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+
+def update_metrics_file(trace, metrics_path):
+  """
+  Folds one job trace into cumulative counters (kept in the helper's SQLite
+  cache, so every worker process contributes) and rewrites metrics_path in
+  the Prometheus text exposition format, e.g. for node_exporter's textfile
+  collector.
+  """
+  increments = [
+    ('video_cdn_jobs_total', _metric_labels(outcome='ok' if trace['ok'] else 'error'), 1),
+    ('video_cdn_job_seconds_total', '', trace['total_seconds']),
+    ('video_cdn_bytes_in_total', '', trace['bytes_in'] or 0),
+    ('video_cdn_bytes_out_total', '', trace['bytes_out'] or 0),
+    ('video_cdn_upload_retries_total', '', trace['upload_retries']),
+  ]
+  if trace['dedup_hit']:
+    increments.append(('video_cdn_dedup_hits_total', '', 1))
+  elif trace['strategy'] or trace['encode_path']:
+    increments.append(('video_cdn_strategy_total', _metric_labels(strategy=trace['strategy'] or trace['encode_path']), 1))
+  for stage, seconds in trace['timings'].items():
+    increments.append(('video_cdn_stage_seconds_total', _metric_labels(stage=stage), seconds))
+    increments.append(('video_cdn_stage_runs_total', _metric_labels(stage=stage), 1))
+  with closing(open_cache_db()) as conn, conn:
+    conn.execute('CREATE TABLE IF NOT EXISTS metrics (name TEXT NOT NULL, labels TEXT NOT NULL, value REAL NOT NULL, '
+                 'PRIMARY KEY (name, labels))')
+    conn.executemany('INSERT INTO metrics (name, labels, value) VALUES (?, ?, ?) '
+                     'ON CONFLICT (name, labels) DO UPDATE SET value = value + excluded.value', increments)
+    rows = conn.execute('SELECT name, labels, value FROM metrics ORDER BY name, labels').fetchall()
+  lines = []
+  previous_name = None
+  for name, labels, value in rows:
+    if name != previous_name:
+      lines.append(f"# TYPE {name} counter")
+      previous_name = name
+    # Full precision: with %g a large counter stops showing small increments
+    text = str(int(value)) if float(value).is_integer() else repr(float(value))
+    lines.append(f"{name}{{{labels}}} {text}" if labels else f"{name} {text}")
+  tmp_path = f"{metrics_path}.{os.getpid()}.tmp"
+  with open(tmp_path, 'w') as f:
+    f.write('\n'.join(lines) + '\n')
+  os.replace(tmp_path, metrics_path)
+
+def emit_trace(local_video_path, report, total_seconds, error):
+  """
+  Writes one machine-readable trace record per job: JSON-lines to
+  VIDEO_CDN_TRACE_FILE ('-' for stderr) and/or cumulative Prometheus
+  counters to VIDEO_CDN_METRICS_FILE. Instrumentation never fails a job.
+  """
+  trace_path = os.getenv('VIDEO_CDN_TRACE_FILE')
+  metrics_path = os.getenv('VIDEO_CDN_METRICS_FILE')
+  if not trace_path and not metrics_path:
+    return
+  trace = {
+    'ts': time.time(),
+    'path': local_video_path,
+    'ok': error is None,
+    'error': str(error) if error is not None else None,
+    'total_seconds': round(total_seconds, 4),
+    'timings': report.get('timings', {}),
+    'bytes_in': report.get('input_bytes'),
+    'bytes_out': report.get('output_bytes'),
+    'encode_path': report.get('encode_path'),
+    'strategy': report.get('strategy'),
+    'strategies_tried': report.get('strategies_tried', []),
+    'upload_retries': report.get('upload_retries', 0),
+    'destination': report.get('destination'),
+    'dedup_hit': report.get('dedup_hit', False),
+  }
+  try:
+    if trace_path == '-':
+      print(json.dumps(trace), file=sys.stderr)
+    elif trace_path:
+      with open(trace_path, 'a') as f:
+        f.write(json.dumps(trace) + '\n')
+    if metrics_path:
+      update_metrics_file(trace, metrics_path)
+  except (OSError, sqlite3.Error) as e:
+    print(f"[DEBUG] Could not write trace/metrics: {e}", file=sys.stderr)
+
+def publish_previews(report):
+  """
+  Uploads the poster and preview strip next to the video (same destination)
+  and records their URLs in report. Preview failures never fail the video.
+  """
+  for path_key, url_key in (('poster_path', 'thumbnail_url'), ('strip_path', 'preview_strip_url')):
+    path = report.pop(path_key, None)
+    if not path or not os.path.isfile(path):
+      continue
+    try:
+      if report.get('url'):
+        report[url_key] = upload_image(path, report.get('destination'))
+    except Exception as e:
+      print(f"[DEBUG] Could not upload {path_key.split('_')[0]}: {e}", file=sys.stderr)
+    finally:
+      if os.path.exists(path):
+        os.remove(path)
+
+# What a dedup hit takes from the cached result: the Video row fields and
+# where they live. Bytes, retries and strategies belong to the original job.
+DEDUP_RESULT_FIELDS = ('url', 'thumbnail_url', 'preview_strip_url', 'width', 'height', 'duration', 'destination')
+
+def process_video(local_video_path, threads=None):
+  """
+  Processes a video and returns a result dict with everything a Video row
+  needs: 'url', 'thumbnail_url', 'preview_strip_url', 'width', 'height' and
+  'duration', plus how it was produced ('encode_path' is 'remux' or
+  'transcode', 'destination' is the storage backend: 'cloudinary', 'gcs',
+  'public' or 'fake'). Content already processed with the current settings
+  is served from the dedup index ('dedup_hit': True) without touching
+  ffmpeg or the network.
+  Set VIDEO_CDN_DEDUP=0 to always re-process.
+  """
+  global _env_load_seconds
+  report = {'url': None, 'thumbnail_url': None, 'preview_strip_url': None, 'width': 0, 'height': 0,
+            'duration': 0.0, 'encode_path': None, 'dedup_hit': False, 'timings': {}}
+  if _env_load_seconds is not None:
+    report['timings']['env_load'] = round(_env_load_seconds, 4)
+    _env_load_seconds = None
+  started = time.perf_counter()
+  error = None
+  try:
+    return _process_video(local_video_path, threads, report)
+  except Exception as e:
+    error = e
+    raise
+  finally:
+    emit_trace(local_video_path, report, time.perf_counter() - started, error)
+
+def _process_video(local_video_path, threads, report):
+  forced_backend()  # Fail on a misspelled backend before probing or encoding
+  dedup_enabled = os.getenv('VIDEO_CDN_DEDUP', '1') != '0'
+  if not dedup_enabled or not os.path.isfile(local_video_path):
+    # Previews are published from the scratch workspace, so it spans both steps
+    with scratch_workspace(local_video_path, report):
+      report['url'] = transcode_and_upload_video(local_video_path, threads=threads, report=report)
+      with timed(report, 'preview_upload'):
+        publish_previews(report)
+    return report
+
+  settings = encode_settings_key()
+  with timed(report, 'dedup_lookup'):
+    digest = content_hash(local_video_path)
+    cached = lookup_dedup(digest, settings)
+  if cached:
+    print(f"[DEBUG] Dedup hit for {local_video_path} ({digest[:12]}), returning cached URL: {cached['url']}", file=sys.stderr)
+    report.update({key: cached[key] for key in DEDUP_RESULT_FIELDS if key in cached})
+    report['dedup_hit'] = True
+    return report
+
+  with scratch_workspace(local_video_path, report):
+    report['url'] = transcode_and_upload_video(local_video_path, threads=threads, report=report)
+    with timed(report, 'preview_upload'):
+      publish_previews(report)
+  if report['url']:
+    record_dedup(digest, settings, {key: value for key, value in report.items() if key != 'timings' and not key.startswith('scratch_')})
+  return report
+
+def process_and_upload_video(local_video_path, threads=None):
+  """
+  Compresses and uploads a video (see process_video) and returns its URL.
+  """
+  return process_video(local_video_path, threads=threads)['url']
+
+# Per-file caps for the encode planner
+MAX_ENCODE_ATTEMPTS = int(os.getenv('VIDEO_CDN_MAX_ENCODE_ATTEMPTS') or 2)
+MAX_ENCODE_SECONDS = float(os.getenv('VIDEO_CDN_MAX_ENCODE_SECONDS') or 1800)  # Floor; long inputs get more
+ENCODE_SECONDS_PER_MEDIA_SECOND = float(os.getenv('VIDEO_CDN_ENCODE_SECONDS_PER_MEDIA_SECOND') or 4)
+
+def encode_time_budget(media):
+  """
+  Wall-time cap for encoding one input: MAX_ENCODE_SECONDS, or
+  ENCODE_SECONDS_PER_MEDIA_SECOND per second of input if that is longer, so
+  a long but healthy video on few threads isn't cut off.
+  """
+  duration = media.duration if media is not None else 0.0
+  return max(MAX_ENCODE_SECONDS, ENCODE_SECONDS_PER_MEDIA_SECOND * duration)
+
+# What each input class should try, most likely to succeed first
+STRATEGY_PLANS = {
+  'healthy': ['standard', 'aggressive'],
+  'av1': ['av1', 'av1_safe'],
+  'missing_moov': ['moov_recovery', 'raw_extract'],
+  'metadata_corrupt': ['remux_then_encode', 'aggressive'],
+  'damaged': ['repair_then_encode', 'aggressive'],
+  'unreadable': ['aggressive', 'raw_extract'],
+}
+
+def classify_error_text(text):
+  """
+  Maps ffprobe/ffmpeg error output to an input class, or None if it says
+  nothing specific.
+  """
+  if 'moov atom not found' in text:
+    return 'missing_moov'
+  if 'contradictionary STSC and STCO' in text or 'error reading header' in text:
+    return 'metadata_corrupt'
+  if ('doesn\'t support hardware accelerated AV1 decoding' in text or
+      'Failed to get pixel format' in text):
+    return 'av1'
+  if 'Error submitting packet to decoder' in text or 'Invalid data found' in text:
+    return 'damaged'
+  return None
+
+def classify_input(media, scan):
+  """
+  Classifies an input from its container scan and probe result before
+  any ffmpeg run. Returns (input_class, reason).
+  """
+  if scan is not None and scan.is_mp4:
+    # The box walk is exact about structure; ffprobe only sees its symptoms
+    if scan.missing_moov:
+      return 'missing_moov', f"container scan: {scan.problems[0]}"
+    if scan.truncated or scan.bad_sizes:
+      return 'damaged', f"container scan: {scan.problems[0]}"
+    if scan.bad_sample_tables:
+      return 'metadata_corrupt', f"container scan: {scan.problems[0]}"
+  if media is None:
+    return 'healthy', 'ffprobe unavailable, assuming a normal input'
+  if not media.ok:
+    error_class = classify_error_text(media.error)
+    if error_class:
+      return error_class, f"ffprobe error: {media.error.splitlines()[-1] if media.error else ''}"
+    return 'unreadable', 'ffprobe failed without a recognised error'
+  if media.video_codec == 'av1':
+    return 'av1', 'video stream is AV1'
+  if not media.has_video:
+    return 'unreadable', 'no video stream found'
+  if 'mp4' in media.container and scan is not None and not scan.is_mp4:
+    return 'damaged', f"MP4/MOV without a recognised leading box ({scan.leading_box!r})"
+  if not media.duration:
+    return 'metadata_corrupt', 'container reports no duration'
+  return 'healthy', f"{media.video_codec}/{media.audio_codec or 'no audio'} in {media.container}"
+
+# ffmpeg stderr kept for error classification: the first lines carry the
+# container/decoder diagnosis, the last ones the final failure
+STDERR_HEAD_LINES = 50
+STDERR_TAIL_LINES = 200
+STDERR_MAX_LINE = 2000
+
+_progress_listener = None
+
+def set_progress_listener(listener):
+  """
+  Registers a callable that receives encode progress dicts (stage, percent,
+  fps, speed, eta_seconds, out_time), or None to stop listening.
+  """
+  global _progress_listener
+  _progress_listener = listener
+
+def emit_progress(event):
+  listener = _progress_listener
+  if listener is not None:
+    try:
+      listener(event)
+    except Exception:
+      pass  # A broken listener must not break the encode
+
+def _parse_speed(value):
+  return _to_float((value or '').rstrip('x'))
+
+class FfmpegRun:
+  """
+  A running ffmpeg process whose stderr is drained in the background into a
+  bounded head/tail buffer, so noisy corrupted inputs can't grow memory
+  without limit. When a progress listener is registered and the media
+  duration is known, ffmpeg also reports -progress on a private pipe and
+  each update is forwarded as a progress event.
+  """
+
+  def __init__(self, cmd, stage=None, duration=None, stdout=subprocess.DEVNULL):
+    self.cmd = cmd
+    self.stage = stage
+    self.duration = duration
+    self._head = []
+    self._tail = deque(maxlen=STDERR_TAIL_LINES)
+    self._dropped = 0
+    progress_fd = None
+    argv = [cmd[0], '-nostats', *cmd[1:]]
+    if _progress_listener is not None and duration:
+      progress_fd, write_fd = os.pipe()
+      argv[1:1] = ['-progress', f'pipe:{write_fd}']
+    self.process = subprocess.Popen(argv, stdin=subprocess.DEVNULL, stdout=stdout, stderr=subprocess.PIPE,
+                                    pass_fds=(write_fd,) if progress_fd is not None else ())
+    self.workspace = _active_workspace
+    if self.workspace is not None:
+      self.workspace.track(self)
+    self._threads = [threading.Thread(target=self._drain_stderr, daemon=True)]
+    if progress_fd is not None:
+      os.close(write_fd)
+      self._threads.append(threading.Thread(target=self._read_progress, args=(progress_fd,), daemon=True))
+    for thread in self._threads:
+      thread.start()
+
+  def _drain_stderr(self):
+    for raw in iter(self.process.stderr.readline, b''):
+      line = raw[:STDERR_MAX_LINE]
+      if len(self._head) < STDERR_HEAD_LINES:
+        self._head.append(line)
+      else:
+        if len(self._tail) == self._tail.maxlen:
+          self._dropped += 1
+        self._tail.append(line)
+    self.process.stderr.close()
+
+  def _read_progress(self, progress_fd):
+    fields = {}
+    with os.fdopen(progress_fd, 'r') as progress:
+      for line in progress:
+        key, _, value = line.strip().partition('=')
+        fields[key] = value
+        if key != 'progress':
+          continue
+        out_time = _to_int(fields.get('out_time_us') or fields.get('out_time_ms')) / 1_000_000
+        speed = _parse_speed(fields.get('speed'))
+        emit_progress({
+          'stage': self.stage,
+          'percent': round(min(100.0, out_time / self.duration * 100), 1) if value != 'end' else 100.0,
+          'fps': _to_float(fields.get('fps')),
+          'speed': speed,
+          'eta_seconds': round(max(0.0, self.duration - out_time) / speed, 1) if speed and value != 'end' else 0.0,
+          'out_time': round(out_time, 3),
+        })
+        fields = {}
+
+  @property
+  def stderr(self):
+    """
+    Captured stderr as bytes: the head, a marker for dropped lines, the tail.
+    """
+    lines = list(self._head)
+    if self._dropped:
+      lines.append(f"[... {self._dropped} stderr lines dropped ...]\n".encode())
+    lines.extend(self._tail)
+    return b''.join(lines)
+
+  def wait(self, timeout=None):
+    """
+    Waits for ffmpeg and returns its exit code. On timeout the process is
+    killed and TimeoutExpired raised.
+    """
+    try:
+      returncode = self.process.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+      self.process.kill()
+      self.process.wait()
+      self._join()
+      raise subprocess.TimeoutExpired(self.cmd, timeout, stderr=self.stderr)
+    self._join()
+    return returncode
+
+  def kill(self):
+    self.process.kill()
+    self.process.wait()
+    self._join()
+
+  def _join(self):
+    for thread in self._threads:
+      thread.join(timeout=5)
+    if self.workspace is not None:
+      self.workspace.untrack(self)
+
+def run_ffmpeg(cmd, timeout=None, stage=None, duration=None):
+  """
+  subprocess.run(cmd, check=True) for ffmpeg with bounded stderr capture
+  and live progress. Raises CalledProcessError (stderr attached) or
+  TimeoutExpired, or ScratchBudgetError if the scratch watchdog stopped it.
+  """
+  run = FfmpegRun(cmd, stage=stage, duration=duration)
+  returncode = run.wait(timeout=timeout)
+  if returncode != 0 and run.workspace is not None and run.workspace.exceeded:
+    raise ScratchBudgetError(f"ffmpeg stopped: job scratch usage went over {run.workspace.limit_bytes} bytes")
+  if returncode != 0:
+    raise subprocess.CalledProcessError(returncode, cmd, stderr=run.stderr)
+
+# Scratch workspace: every intermediate of a job (compressed output,
+# remux/repair copies, segments, passlogs, poster/strip) lives in one
+# private directory on VIDEO_CDN_SCRATCH_DIR (point it at a tmpfs or local
+# SSD), which is removed when the job ends however it ends. Space is
+# reserved before the job starts against a budget shared by every worker
+# process on the host; jobs that don't fit wait in line.
+SCRATCH_DIR = os.getenv('VIDEO_CDN_SCRATCH_DIR') or os.path.join(tempfile.gettempdir(), 'video_cdn_scratch')
+SCRATCH_JOB_BYTES = int(float(os.getenv('VIDEO_CDN_SCRATCH_JOB_MB') or 0) * 1024 * 1024)  # 0: the job's reservation is its cap
+SCRATCH_TOTAL_BYTES = int(float(os.getenv('VIDEO_CDN_SCRATCH_TOTAL_MB') or 0) * 1024 * 1024)  # 0: 90% of what scratch can use
+SCRATCH_WAIT_SECONDS = float(os.getenv('VIDEO_CDN_SCRATCH_WAIT_SECONDS') or 3600)
+# Worst case is the segmented encode: a stream copy of the input plus the
+# encoded pieces plus the concatenated output
+SCRATCH_INPUT_FACTOR = 3.0
+SCRATCH_OVERHEAD_BYTES = 16 * 1024 * 1024  # Previews, passlogs, concat lists
+SCRATCH_POLL_SECONDS = 1.0
+
+class ScratchBudgetError(RuntimeError):
+  pass
+
+_active_workspace = None
+
+def _pid_alive(pid):
+  try:
+    os.kill(pid, 0)
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    pass
+  return True
+
+def directory_bytes(path):
+  total = 0
+  for entry in os.scandir(path):
+    try:
+      if entry.is_dir(follow_symlinks=False):
+        total += directory_bytes(entry.path)
+      else:
+        total += entry.stat(follow_symlinks=False).st_blocks * 512
+    except FileNotFoundError:
+      pass  # Removed while we looked
+  return total
+
+class ScratchWorkspace:
+  """
+  One job's scratch directory and its reservation. While active, a watchdog
+  samples the directory's size; past the per-job cap it kills the job's
+  running ffmpeg processes, and run_ffmpeg turns that into a
+  ScratchBudgetError instead of a strategy failure.
+  """
+
+  def __init__(self, reserve_bytes, limit_bytes):
+    self.reserve_bytes = reserve_bytes
+    self.limit_bytes = limit_bytes
+    self.path = None
+    self.peak_bytes = 0
+    self.exceeded = False
+    self._processes = set()
+    self._lock = threading.Lock()
+    self._stop = threading.Event()
+    self._watchdog = None
+
+  def file(self, name):
+    return os.path.join(self.path, name)
+
+  def reserve(self):
+    """
+    Creates the directory once its reservation fits the global budget,
+    polling until SCRATCH_WAIT_SECONDS. Reservations live in the helper's
+    SQLite cache; those of dead processes are reclaimed along with their
+    directories. Without VIDEO_CDN_SCRATCH_TOTAL_MB the budget is 90% of
+    what scratch can actually use: the volume's free space plus what the
+    live jobs have already written, so other data on the volume counts.
+    A job that doesn't fit an idle budget still runs, alone.
+    """
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    deadline = time.monotonic() + SCRATCH_WAIT_SECONDS
+    queued = False
+    path = tempfile.mkdtemp(prefix=f"job_{os.getpid()}_", dir=SCRATCH_DIR)
+    while True:
+      try:
+        with closing(open_cache_db()) as conn, conn:
+          conn.execute('CREATE TABLE IF NOT EXISTS scratch_reservations (path TEXT PRIMARY KEY, pid INTEGER NOT NULL, '
+                       'bytes INTEGER NOT NULL, created_at REAL NOT NULL)')
+          conn.execute('BEGIN IMMEDIATE')
+          reserved = written = 0
+          for other_path, pid, size in conn.execute('SELECT path, pid, bytes FROM scratch_reservations').fetchall():
+            if _pid_alive(pid):
+              reserved += size
+              if os.path.isdir(other_path):
+                written += directory_bytes(other_path)
+            else:
+              print(f"[DEBUG] Reclaiming scratch space of dead job {pid}: {other_path}", file=sys.stderr)
+              conn.execute('DELETE FROM scratch_reservations WHERE path = ?', (other_path,))
+              shutil.rmtree(other_path, ignore_errors=True)
+          budget = SCRATCH_TOTAL_BYTES or int((shutil.disk_usage(SCRATCH_DIR).free + written) * 0.9)
+          if reserved == 0 or reserved + self.reserve_bytes <= budget:
+            conn.execute('INSERT INTO scratch_reservations (path, pid, bytes, created_at) VALUES (?, ?, ?, ?)',
+                         (path, os.getpid(), self.reserve_bytes, time.time()))
+            self.path = path
+      except sqlite3.Error as e:
+        # Without the shared ledger the job still gets its directory and cleanup
+        print(f"[DEBUG] Scratch reservation skipped: {e}", file=sys.stderr)
+        self.path = path
+      if self.path:
+        break
+      if time.monotonic() >= deadline:
+        os.rmdir(path)
+        raise ScratchBudgetError(f"No scratch space for {self.reserve_bytes} bytes after {SCRATCH_WAIT_SECONDS:.0f}s "
+                                 f"({reserved} of {budget} bytes reserved in {SCRATCH_DIR})")
+      if not queued:
+        print(f"[DEBUG] Scratch budget exhausted ({reserved} of {budget} bytes reserved), "
+              f"queueing for {self.reserve_bytes} bytes", file=sys.stderr)
+        queued = True
+      time.sleep(SCRATCH_POLL_SECONDS)
+    self._watchdog = threading.Thread(target=self._watch, daemon=True)
+    self._watchdog.start()
+
+  def release(self):
+    self._stop.set()
+    if self._watchdog is not None:
+      self._watchdog.join()
+    if self.path is None:
+      return
+    self.sample()
+    shutil.rmtree(self.path, ignore_errors=True)
+    try:
+      with closing(open_cache_db()) as conn, conn:
+        conn.execute('DELETE FROM scratch_reservations WHERE path = ?', (self.path,))
+    except sqlite3.Error as e:
+      print(f"[DEBUG] Scratch reservation release skipped: {e}", file=sys.stderr)
+
+  def track(self, run):
+    with self._lock:
+      self._processes.add(run)
+
+  def untrack(self, run):
+    with self._lock:
+      self._processes.discard(run)
+    # Outputs are at their largest right after a run; short jobs may finish between watchdog samples
+    self.sample()
+
+  def sample(self):
+    used = directory_bytes(self.path)
+    self.peak_bytes = max(self.peak_bytes, used)
+    return used
+
+  def _watch(self):
+    while not self._stop.wait(SCRATCH_POLL_SECONDS):
+      used = self.sample()
+      if self.limit_bytes and used > self.limit_bytes and not self.exceeded:
+        print(f"[ERROR] Job scratch usage {used} bytes is over its {self.limit_bytes} byte budget, stopping ffmpeg", file=sys.stderr)
+        self.exceeded = True
+        with self._lock:
+          for run in self._processes:
+            run.process.kill()
+
+@contextmanager
+def scratch_workspace(local_video_path, report):
+  """
+  Yields the job's ScratchWorkspace, reserving room for its intermediates
+  (SCRATCH_INPUT_FACTOR x the input, capped at VIDEO_CDN_SCRATCH_JOB_MB)
+  first and deleting the directory afterwards. The watchdog holds the job
+  to VIDEO_CDN_SCRATCH_JOB_MB, or to its reservation if that isn't set, so
+  the shared budget is enforced and not just booked. Nested calls share
+  the outer workspace.
+  """
+  global _active_workspace
+  if _active_workspace is not None:
+    yield _active_workspace
+    return
+  input_bytes = os.path.getsize(local_video_path) if os.path.isfile(local_video_path) else 0
+  estimate = int(input_bytes * SCRATCH_INPUT_FACTOR) + SCRATCH_OVERHEAD_BYTES
+  reserve_bytes = min(estimate, SCRATCH_JOB_BYTES) if SCRATCH_JOB_BYTES else estimate
+  workspace = ScratchWorkspace(reserve_bytes, SCRATCH_JOB_BYTES or reserve_bytes)
+  with timed(report, 'scratch_wait'):
+    workspace.reserve()
+  _active_workspace = workspace
+  try:
+    yield workspace
+  finally:
+    _active_workspace = None
+    workspace.release()
+    report['scratch_reserved_bytes'] = workspace.reserve_bytes
+    report['scratch_peak_bytes'] = workspace.peak_bytes
+
+# Poster and preview strip, written as extra outputs of the encode so the
+# frames come from the same decode as the video
+POSTER_WIDTH = 640
+STRIP_FRAMES = 10
+STRIP_FRAME_WIDTH = 160
+# Repair strategies read damaged input; keep their command as simple as possible
+PREVIEW_STRATEGIES = ('standard', 'av1', 'av1_safe', 'remux_then_encode', 'repair_then_encode')
+
+def preview_paths(compressed_path):
+  base = os.path.splitext(compressed_path)[0]
+  return base + '_poster.jpg', base + '_strip.jpg'
+
+def preview_output_args(media, poster_path, strip_path):
+  """
+  ffmpeg output options for a poster JPEG (about 10% in, at most 5s) and a
+  STRIP_FRAMES-wide preview strip sampled evenly across the video.
+  """
+  duration = media.duration if media is not None and media.duration else 10.0
+  poster_at = min(duration * 0.1, 5.0)
+  return [
+    '-map', '0:v:0', '-an', '-sn',
+    '-vf', f"select='gte(t,{poster_at:.3f})',scale={POSTER_WIDTH}:-2",
+    '-frames:v', '1', '-update', '1', '-q:v', '3', poster_path,
+    '-map', '0:v:0', '-an', '-sn',
+    '-vf', f"fps={STRIP_FRAMES}/{max(1, int(duration))},scale={STRIP_FRAME_WIDTH}:-2,tile={STRIP_FRAMES}x1",
+    '-frames:v', '1', '-update', '1', '-q:v', '5', strip_path,
+  ]
+
+def extract_previews(video_path, ffmpeg_bin, media, poster_path, strip_path, thread_args=()):
+  """
+  Fallback for outputs that weren't encoded with the previews attached
+  (remux fast path, repair strategies): decodes keyframes only, which is
+  a small fraction of a full pass. Returns True on success.
+  """
+  cmd = with_thread_limits([ffmpeg_bin, '-y', '-skip_frame', 'nokey', '-i', video_path, *preview_output_args(media, poster_path, strip_path)],
+                           thread_args)
+  print(f"[DEBUG] Extracting previews from keyframes: {' '.join(cmd)}", file=sys.stderr)
+  try:
+    run_ffmpeg(cmd, stage='previews')
+    return True
+  except subprocess.CalledProcessError as e:
+    print(f"[DEBUG] Preview extraction failed: {e.stderr.decode(errors='replace')[-2000:] if e.stderr else 'No error details'}", file=sys.stderr)
+    return False
+
+# Size-targeted encoding: keep outputs under the Cloudinary cap on the first
+# encode instead of finding out afterwards. 0 disables it.
+TARGET_SIZE_BYTES = int(float(os.getenv('VIDEO_CDN_TARGET_SIZE_MB') or 95) * 1024 * 1024)
+TARGET_AUDIO_BITRATE = 128_000
+MIN_TARGET_VIDEO_BITRATE = 150_000  # Below this the target isn't worth hitting
+CRF28_BITS_PER_PIXEL = 0.06  # Rough libx264 CRF 28 rate for typical footage
+MUX_OVERHEAD = 0.97
+
+def plan_size_target(media, target_bytes=TARGET_SIZE_BYTES):
+  """
+  Picks rate control so the encode lands under target_bytes, using the
+  probed duration. Returns a dict with 'mode' ('crf', 'capped' or
+  'two_pass'), the video bitrate cap and the predicted output size.
+  """
+  if not target_bytes or media is None or not media.ok or not media.duration:
+    return {'mode': 'crf', 'video_bitrate': None, 'predicted_bytes': None, 'target_bytes': target_bytes or None}
+  budget = target_bytes * 8 / media.duration * MUX_OVERHEAD
+  video_budget = int(budget - TARGET_AUDIO_BITRATE)
+  fps = media.frame_rate or 30
+  expected = media.width * media.height * fps * CRF28_BITS_PER_PIXEL
+  source_rate = media.video_bit_rate or media.bit_rate
+  if source_rate:
+    expected = min(expected, source_rate) if expected else source_rate
+  if video_budget < MIN_TARGET_VIDEO_BITRATE:
+    # The target is out of reach; the output is headed for the large-file path anyway
+    mode, video_bitrate, predicted_rate = 'crf', None, expected + TARGET_AUDIO_BITRATE if expected else None
+  elif expected and expected > 1.5 * video_budget:
+    mode, video_bitrate, predicted_rate = 'two_pass', video_budget, video_budget + TARGET_AUDIO_BITRATE
+  else:
+    # CRF under a VBV cap: costs nothing when the clip fits anyway, and
+    # bounds the size when the bits-per-pixel guess is wrong
+    predicted_video = min(expected, video_budget) if expected else video_budget
+    mode, video_bitrate, predicted_rate = 'capped', video_budget, predicted_video + TARGET_AUDIO_BITRATE
+  return {
+    'mode': mode,
+    'video_bitrate': video_bitrate,
+    'predicted_bytes': int(predicted_rate * media.duration / 8 / MUX_OVERHEAD) if predicted_rate else None,
+    'target_bytes': target_bytes,
+  }
+
+def apply_size_target(strategy, commands, intermediates, size_plan, compressed_path):
+  """
+  Adds the size plan's rate control to a strategy's final encode command.
+  Two-pass is only used for the clean-input strategies; repair strategies
+  get the VBV cap so a broken file isn't decoded twice.
+  """
+  if size_plan['mode'] == 'crf':
+    return commands, intermediates
+  rate = str(size_plan['video_bitrate'])
+  encode = commands[-1]
+  if size_plan['mode'] == 'two_pass' and strategy in ('standard', 'av1') and '-crf' in encode:
+    crf_index = encode.index('-crf')
+    base = encode[:crf_index] + ['-b:v', rate, '-b:a', str(TARGET_AUDIO_BITRATE)] + encode[crf_index + 2:]
+    passlog = compressed_path + '.passlog'
+    first_pass = base[:-1] + ['-pass', '1', '-passlogfile', passlog, '-an', '-f', 'null', os.devnull]
+    second_pass = base[:-1] + ['-pass', '2', '-passlogfile', passlog, base[-1]]
+    return commands[:-1] + [first_pass, second_pass], intermediates + [passlog + '-0.log', passlog + '-0.log.mbtree']
+  capped = encode[:-1] + ['-maxrate', rate, '-bufsize', str(2 * size_plan['video_bitrate']), '-b:a', str(TARGET_AUDIO_BITRATE), encode[-1]]
+  return commands[:-1] + [capped], intermediates
+
+def with_thread_limits(cmd, thread_args):
+  """
+  Applies a job's -threads cap to the whole ffmpeg run. As an output option
+  it only limits the encoder, so it is also given before each input (the
+  decoders) and as -filter_threads (scale/preview filter graphs). An input
+  that already sets its own -threads (av1_safe) keeps it.
+  """
+  if not thread_args:
+    return cmd
+  threads = thread_args[1]
+  limited = [cmd[0], '-filter_threads', threads]
+  input_start = len(limited)
+  for arg in cmd[1:]:
+    if arg == '-i':
+      if '-threads' not in limited[input_start:]:
+        limited += ['-threads', threads]
+      input_start = len(limited) + 2
+    limited.append(arg)
+  return limited
+
+def build_strategy(strategy, local_video_path, compressed_path, ffmpeg_bin, thread_args):
+  """
+  Returns (commands, intermediates) for an encode strategy: the ffmpeg
+  commands to run in order and the scratch files they leave behind.
+  """
+  if strategy == 'standard':
+    return [[
+      ffmpeg_bin, '-y', '-i', local_video_path,
+      '-c:v', 'libx264',  # Output codec
+      '-crf', '28',
+      '-preset', 'fast',
+      '-c:a', 'aac',  # Audio codec
+      '-movflags', '+faststart',  # Web optimization
+      '-pix_fmt', 'yuv420p',  # Ensure compatibility
+      *thread_args,
+      compressed_path
+    ]], []
+  if strategy == 'av1':
+    # For AV1 videos, force software decoding and add specific options
+    return [[
+      ffmpeg_bin, '-y',
+      '-hwaccel', 'none',  # Force software decoding
+      '-i', local_video_path,
+      '-c:v', 'libx264',
+      '-crf', '28',
+      '-preset', 'medium',  # Slower but more compatible for AV1
+      '-c:a', 'aac',
+      '-movflags', '+faststart',
+      '-pix_fmt', 'yuv420p',
+      *thread_args,
+      compressed_path
+    ]], []
+  if strategy == 'av1_safe':
+    return [[
+      ffmpeg_bin, '-y',
+      '-threads', '1',  # Single thread for stability
+      '-hwaccel', 'none',
+      '-i', local_video_path,
+      '-c:v', 'libx264',
+      '-crf', '28',
+      '-preset', 'ultrafast',  # Fastest preset for problematic AV1
+      '-c:a', 'aac',
+      '-ac', '2',  # Force stereo
+      '-ar', '44100',  # Force sample rate
+      '-movflags', '+faststart',
+      '-pix_fmt', 'yuv420p',
+      '-avoid_negative_ts', 'make_zero',
+      '-max_muxing_queue_size', '1024',
+      *thread_args,
+      compressed_path
+    ]], []
+  if strategy == 'moov_recovery':
+    # Scan the whole file for streams to rebuild missing metadata
+    return [[
+      ffmpeg_bin, '-y', '-analyzeduration', '2147483647', '-probesize', '2147483647',
+      '-i', local_video_path,
+      '-c:v', 'libx264', '-crf', '28', '-preset', 'ultrafast',
+      '-c:a', 'aac', '-movflags', '+faststart',
+      '-f', 'mp4',
+      *thread_args,
+      compressed_path
+    ]], []
+  if strategy == 'remux_then_encode':
+    # Remux without re-encoding to fix the container, then compress
+    remux_path = os.path.splitext(compressed_path)[0] + '_remuxed.mp4'
+    return [[
+      ffmpeg_bin, '-y', '-i', local_video_path,
+      '-c', 'copy',
+      '-avoid_negative_ts', 'make_zero',
+      '-fflags', '+genpts',
+      '-map_metadata', '-1',  # Strip problematic metadata
+      remux_path
+    ], [
+      ffmpeg_bin, '-y', '-i', remux_path,
+      '-c:v', 'libx264', '-crf', '28', '-preset', 'fast',
+      '-c:a', 'aac', '-movflags', '+faststart', '-pix_fmt', 'yuv420p',
+      *thread_args,
+      compressed_path
+    ]], [remux_path]
+  if strategy == 'repair_then_encode':
+    repaired_path = os.path.splitext(compressed_path)[0] + '_repaired.mp4'
+    return [[
+      ffmpeg_bin, '-y', '-err_detect', 'ignore_err', '-i', local_video_path,
+      '-c', 'copy', '-f', 'mp4',
+      repaired_path
+    ], [
+      ffmpeg_bin, '-y', '-i', repaired_path,
+      '-c:v', 'libx264', '-crf', '28', '-preset', 'fast',
+      '-c:a', 'aac', '-movflags', '+faststart', '-pix_fmt', 'yuv420p',
+      *thread_args,
+      compressed_path
+    ]], [repaired_path]
+  if strategy == 'aggressive':
+    return [[
+      ffmpeg_bin, '-y', '-err_detect', 'ignore_err', '-i', local_video_path,
+      '-c:v', 'libx264',
+      '-crf', '28',
+      '-preset', 'ultrafast',
+      '-c:a', 'aac',
+      '-movflags', '+faststart',
+      '-pix_fmt', 'yuv420p',
+      '-avoid_negative_ts', 'make_zero',
+      '-fflags', '+genpts+discardcorrupt',
+      '-max_muxing_queue_size', '1024',
+      '-fps_mode', 'cfr',  # Constant frame rate (updated from deprecated -vsync)
+      *thread_args,
+      compressed_path
+    ]], []
+  if strategy == 'raw_extract':
+    return [[
+      ffmpeg_bin, '-y', '-analyzeduration', '2147483647', '-probesize', '2147483647',
+      '-err_detect', 'ignore_err', '-i', local_video_path,
+      '-map', '0', '-ignore_unknown',
+      '-c:v', 'libx264', '-crf', '28', '-preset', 'ultrafast',
+      '-c:a', 'aac', '-ac', '2', '-ar', '44100',
+      '-pix_fmt', 'yuv420p',
+      '-f', 'mp4', '-movflags', '+faststart',
+      '-avoid_negative_ts', 'make_zero',
+      '-fflags', '+genpts+discardcorrupt+igndts',
+      '-fps_mode', 'cfr',
+      '-max_muxing_queue_size', '4096',
+      '-max_interleave_delta', '0',
+      *thread_args,
+      compressed_path
+    ]], []
+  raise ValueError(f"Unknown encode strategy: {strategy}")
+
+# Long healthy inputs are split at keyframes and the pieces encoded in
+# parallel. 0 disables it.
+SEGMENTED_MIN_DURATION = float(os.getenv('VIDEO_CDN_SEGMENT_MIN_SECONDS') or 600)
+SEGMENT_MIN_LENGTH = 30.0  # Shorter pieces cost more in per-process startup than they win
+SEGMENTED_MIN_CPUS = 4
+
+def encode_segmented(local_video_path, compressed_path, ffmpeg_bin, media, thread_args, size_plan, deadline):
+  """
+  Splits the video stream at keyframes (stream copy), encodes the pieces
+  in parallel within the job's core budget, then concatenates them without
+  re-encoding and muxes in the audio, encoded once from the original so
+  there are no AAC priming gaps at segment boundaries. The output has the
+  same H.264/AAC +faststart layout as the single-process encode.
+  Raises CalledProcessError/TimeoutExpired like subprocess.run.
+  """
+  cpu_budget = int(thread_args[1]) if thread_args else available_cpus()
+  workers, segment_threads = plan_batch(cpu_budget, cpu_budget=cpu_budget)
+  segment_time = max(SEGMENT_MIN_LENGTH, media.duration / (2 * workers))
+  work_dir = tempfile.mkdtemp(prefix='segments_', dir=os.path.dirname(os.path.abspath(compressed_path)))
+
+  def run(cmd, stage=None, limits=thread_args):
+    cmd = with_thread_limits(cmd, limits)
+    run_ffmpeg(cmd, timeout=max(1, deadline - time.monotonic()), stage=stage, duration=media.duration if stage else None)
+
+  try:
+    split_cmd = [
+      ffmpeg_bin, '-y', '-i', local_video_path,
+      '-map', '0:v:0', '-c', 'copy',
+      '-f', 'segment', '-segment_time', f"{segment_time:.3f}", '-reset_timestamps', '1',
+      os.path.join(work_dir, 'source_%05d.mkv')
+    ]
+    print(f"[DEBUG] Splitting at keyframes into ~{segment_time:.0f}s segments: {' '.join(split_cmd)}", file=sys.stderr)
+    run(split_cmd, stage='segmented:split')
+    sources = sorted(name for name in os.listdir(work_dir) if name.startswith('source_'))
+    print(f"[DEBUG] Encoding {len(sources)} segments on {workers} workers x {segment_threads} threads", file=sys.stderr)
+
+    def encode(name):
+      encoded_path = os.path.join(work_dir, name.replace('source_', 'encoded_'))
+      cmd = [
+        ffmpeg_bin, '-y', '-i', os.path.join(work_dir, name),
+        '-an', '-c:v', 'libx264', '-crf', '28', '-preset', 'fast', '-pix_fmt', 'yuv420p',
+        '-threads', str(segment_threads),
+        encoded_path
+      ]
+      run(apply_size_target('segmented', [cmd], [], size_plan, compressed_path)[0][-1], limits=['-threads', str(segment_threads)])
+      return encoded_path
+
+    from concurrent.futures import ThreadPoolExecutor
+    pool = ThreadPoolExecutor(max_workers=workers)
+    try:
+      encoded = list(pool.map(encode, sources))
+    finally:
+      # One failed segment fails the strategy; don't start the rest
+      pool.shutdown(cancel_futures=True)
+
+    concat_list = os.path.join(work_dir, 'segments.txt')
+    with open(concat_list, 'w') as f:
+      for path in encoded:
+        f.write(f"file '{path}'\n")
+    concat_cmd = [
+      ffmpeg_bin, '-y', '-f', 'concat', '-safe', '0', '-i', concat_list, '-i', local_video_path,
+      '-map', '0:v:0', '-map', '1:a:0?',
+      '-c:v', 'copy', '-c:a', 'aac',
+      *(['-b:a', str(TARGET_AUDIO_BITRATE)] if size_plan['mode'] != 'crf' else []),
+      '-movflags', '+faststart',
+      compressed_path
+    ]
+    print(f"[DEBUG] Concatenating segments: {' '.join(concat_cmd)}", file=sys.stderr)
+    run(concat_cmd, stage='segmented:concat')
+  finally:
+    shutil.rmtree(work_dir, ignore_errors=True)
+
+def encode_with_plan(local_video_path, compressed_path, ffmpeg_bin, media, scan, thread_args, report):
+  """
+  Classifies the input up front and runs the single most likely encode
+  strategy, falling back at most MAX_ENCODE_ATTEMPTS - 1 times (steered by
+  the failed run's stderr) and never past encode_time_budget(media) of wall
+  time. Running out of time raises TimeoutExpired, not the corrupted-file
+  error.
+  """
+  input_class, reason = classify_input(media, scan)
+  plan = list(STRATEGY_PLANS[input_class])
+  print(f"[DEBUG] Input classified as '{input_class}' ({reason}); plan: {' -> '.join(plan)}", file=sys.stderr)
+  report['input_class'] = input_class
+  report['strategies_tried'] = []
+  if (input_class == 'healthy' and SEGMENTED_MIN_DURATION and media is not None and media.duration >= SEGMENTED_MIN_DURATION
+      and (int(thread_args[1]) if thread_args else available_cpus()) >= SEGMENTED_MIN_CPUS):
+    # Long video on enough cores: try segmented first; 'standard' stays as its fallback
+    plan.insert(0, 'segmented')
+    print(f"[DEBUG] {media.duration:.0f}s input, using keyframe-segmented parallel encode", file=sys.stderr)
+  size_plan = plan_size_target(media)
+  report['size_target'] = size_plan
+  if size_plan['mode'] != 'crf':
+    print(f"[DEBUG] Size target {size_plan['target_bytes']} bytes: {size_plan['mode']} at {size_plan['video_bitrate']} b/s "
+          f"(predicted {size_plan['predicted_bytes']} bytes)", file=sys.stderr)
+
+  budget = encode_time_budget(media)
+  deadline = time.monotonic() + budget
+  last_error = None
+  timed_out = False
+  # 'segmented' is an optimisation, not a repair attempt, so it doesn't count
+  while plan and len([st for st in report['strategies_tried'] if st != 'segmented']) < MAX_ENCODE_ATTEMPTS:
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+      print(f"[DEBUG] Encode wall-time budget of {budget:.0f}s exhausted", file=sys.stderr)
+      timed_out = True
+      break
+    strategy = plan.pop(0)
+    report['strategies_tried'].append(strategy)
+    if strategy == 'segmented':
+      commands, intermediates = [], []
+    else:
+      commands, intermediates = build_strategy(strategy, local_video_path, compressed_path, ffmpeg_bin, thread_args)
+      commands, intermediates = apply_size_target(strategy, commands, intermediates, size_plan, compressed_path)
+    with_previews = media is not None and media.has_video and strategy in PREVIEW_STRATEGIES
+    if with_previews:
+      commands[-1] = commands[-1] + preview_output_args(media, *preview_paths(compressed_path))
+    commands = [with_thread_limits(cmd, thread_args) for cmd in commands]
+    try:
+      with timed(report, f"encode:{strategy}"):
+        if strategy == 'segmented':
+          encode_segmented(local_video_path, compressed_path, ffmpeg_bin, media, thread_args, size_plan, deadline)
+        for cmd in commands:
+          print(f"[DEBUG] Running ffmpeg ({strategy}): {' '.join(cmd)}", file=sys.stderr)
+          run_ffmpeg(cmd, timeout=max(1, deadline - time.monotonic()),
+                     stage=f"encode:{strategy}", duration=media.duration if media is not None else None)
+      report['strategy'] = strategy
+      report['previews_inline'] = with_previews
+      print(f"[DEBUG] FFmpeg '{strategy}' encode completed successfully", file=sys.stderr)
+      return
+    except subprocess.TimeoutExpired as e:
+      print(f"[DEBUG] FFmpeg '{strategy}' hit the encode wall-time budget of {budget:.0f}s", file=sys.stderr)
+      last_error = e
+      timed_out = True
+      break
+    except subprocess.CalledProcessError as e:
+      stderr_content = e.stderr.decode(errors='replace') if e.stderr else ''
+      print(f"[DEBUG] FFmpeg '{strategy}' failed: {stderr_content[-2000:] or 'No error details'}", file=sys.stderr)
+      last_error = e
+      # Let the failure steer the next attempt if it points somewhere new
+      error_class = classify_error_text(stderr_content)
+      if error_class and error_class != input_class:
+        steered = [st for st in STRATEGY_PLANS[error_class] if st not in report['strategies_tried']]
+        if steered:
+          print(f"[DEBUG] Error looks like '{error_class}', trying {steered[0]} next", file=sys.stderr)
+          plan = [steered[0]] + [st for st in plan if st != steered[0]]
+    finally:
+      for path in intermediates:
+        if os.path.exists(path):
+          os.remove(path)
+
+  for path in (compressed_path, *preview_paths(compressed_path)):
+    if os.path.exists(path):
+      os.remove(path)
+  if timed_out:
+    # Slow is not corrupt: don't report it as a bad (seed) file
+    print(f"[ERROR] Encode did not finish within {budget:.0f}s ({', '.join(report['strategies_tried'])})", file=sys.stderr)
+    if isinstance(last_error, subprocess.TimeoutExpired):
+      raise last_error
+    raise subprocess.TimeoutExpired(report['strategies_tried'][-1] if report['strategies_tried'] else 'ffmpeg', budget)
+  print(f"[ERROR] All planned encode attempts failed ({', '.join(report['strategies_tried'])}). File appears to be corrupted.", file=sys.stderr)
+  # Check if this is a seed operation and we should skip this file
+  file_name = os.path.basename(local_video_path)
+  if '_seed.mp4' in file_name:
+    print(f"[WARNING] Skipping corrupted seed file: {file_name}", file=sys.stderr)
+    raise ValueError(f"Video file {file_name} is corrupted and cannot be processed. Consider removing it from the seed data.")
+  raise last_error if last_error else RuntimeError(f"No encode attempt could be made for {file_name}")
+
+# Fragmented MP4 can be written to a pipe; the moov comes first, so it
+# streams like +faststart output without a second pass over the file.
+STREAMING_MOVFLAGS = 'frag_keyframe+empty_moov+default_base_moof'
+
+def streaming_enabled():
+  return os.getenv('VIDEO_CDN_STREAMING', '0') == '1'
+
+class CountingReader:
+  """
+  Wraps a binary stream and counts the bytes read through it.
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.bytes_read = 0
+
+  def read(self, size=-1):
+    data = self.stream.read(size)
+    self.bytes_read += len(data)
+    return data
 
-def process_and_upload_video(local_video_path):
+def stream_encode_and_upload(local_video_path, compressed_path, ffmpeg_bin, media, scan, thread_args, report):
+  """
+  Encodes straight into the large-file destination: ffmpeg writes
+  fragmented MP4 to a pipe that feeds a GCS resumable session (production)
+  or the public/videos file (development) while it is still encoding, so
+  nothing is staged on disk. Only used when the output is expected to
+  exceed the Cloudinary cap (report['expected_output_bytes']), so it routes
+  like the file-based path would. Returns the URL, or None if the input
+  isn't a candidate or the stream failed (the caller then runs the normal
+  encode path). The encode gets the same encode_time_budget(media) as the
+  file-based planner; running out of it raises TimeoutExpired.
+  """
+  input_class, reason = classify_input(media, scan)
+  if input_class not in ('healthy', 'av1'):
+    print(f"[DEBUG] Streaming skipped for '{input_class}' input ({reason})", file=sys.stderr)
+    return None
+
+  # The size cap doesn't matter here: large-file destinations have none
+  remux = is_web_ready(media, 0, scan)
+  if remux:
+    decode_args, codec_args = [], ['-c', 'copy']
+  elif input_class == 'av1':
+    decode_args = ['-hwaccel', 'none']  # Force software decoding
+    codec_args = ['-c:v', 'libx264', '-crf', '28', '-preset', 'medium', '-c:a', 'aac', '-pix_fmt', 'yuv420p', *thread_args]
+  else:
+    decode_args = []
+    codec_args = ['-c:v', 'libx264', '-crf', '28', '-preset', 'fast', '-c:a', 'aac', '-pix_fmt', 'yuv420p', *thread_args]
+  cmd = [ffmpeg_bin, '-y', *decode_args, '-i', local_video_path, *codec_args,
+         '-movflags', STREAMING_MOVFLAGS, '-f', 'mp4', 'pipe:1']
+  if media is not None and media.has_video and not remux:
+    cmd += preview_output_args(media, *preview_paths(compressed_path))
+  cmd = with_thread_limits(cmd, thread_args)
+
+  dest_name = os.path.basename(compressed_path)
+  destination = select_backend(report['expected_output_bytes'])
+  if destination not in ('gcs', 'public'):
+    print(f"[DEBUG] Streaming skipped: the '{destination}' backend takes whole files only", file=sys.stderr)
+    return None
+  print(f"[DEBUG] Streaming encode to {'GCS' if destination == 'gcs' else 'public/videos'}: {' '.join(cmd)}", file=sys.stderr)
+  blob = None
+  dest_path = None
+  budget = encode_time_budget(media)
+  deadline = time.monotonic() + budget
+  run = FfmpegRun(cmd, stage='stream', duration=media.duration if media is not None else None, stdout=subprocess.PIPE)
+  output = CountingReader(run.process.stdout)
+  # The upload reads until ffmpeg exits, so a stuck encode has to be killed to end it
+  expired = threading.Event()
+  def expire():
+    expired.set()
+    run.process.kill()
+  watchdog = threading.Timer(budget, expire)
+  watchdog.daemon = True
+  watchdog.start()
+  try:
+    if destination == 'gcs':
+      blob = get_gcs_client().bucket(GcsBackend.bucket_name).blob(dest_name)
+      session_url = blob.create_resumable_upload_session(content_type='video/mp4')
+      upload_stream_to_session(session_url, output, stats=report)
+      url = blob.public_url
+    else:
+      os.makedirs(PUBLIC_VIDEOS_DIR, exist_ok=True)
+      dest_path = os.path.join(PUBLIC_VIDEOS_DIR, dest_name)
+      with open(dest_path, 'wb') as out:
+        shutil.copyfileobj(output, out, UPLOAD_CHUNK_BYTES)
+      url = f"/videos/{dest_name}"
+    returncode = run.wait(timeout=max(1, deadline - time.monotonic()))
+  except Exception as e:
+    run.kill()
+    returncode = None
+    if isinstance(e, subprocess.TimeoutExpired):
+      expired.set()
+    print(f"[DEBUG] Streaming upload failed: {e}", file=sys.stderr)
+  finally:
+    watchdog.cancel()
+    run.process.stdout.close()
+  timed_out = expired.is_set() and returncode != 0
+  if timed_out:
+    returncode = None
+    print(f"[ERROR] Streaming encode did not finish within {budget:.0f}s", file=sys.stderr)
+
+  if returncode == 0:
+    report['output_bytes'] = output.bytes_read
+    report['encode_path'] = 'remux' if remux else 'transcode'
+    report['streamed'] = True
+    report['previews_inline'] = not remux
+    report['destination'] = destination
+    print(f"[DEBUG] Streaming encode and upload completed: {url}", file=sys.stderr)
+    return url
+
+  if returncode is not None:
+    print(f"[DEBUG] Streaming ffmpeg failed (exit {returncode}): {run.stderr[-2000:].decode(errors='replace')}", file=sys.stderr)
+  # Don't leave a truncated object behind
+  if dest_path and os.path.exists(dest_path):
+    os.remove(dest_path)
+  if blob is not None:
+    try:
+      blob.delete()
+    except Exception as e:
+      print(f"[DEBUG] Could not delete partial streamed object: {e}", file=sys.stderr)
+  if timed_out:
+    # Slow, not broken: a second full encode on the file path would only be slower
+    raise subprocess.TimeoutExpired(cmd, budget)
+  return None
+
+def transcode_and_upload_video(local_video_path, threads=None, report=None):
   """
   Downloads, compresses, and uploads a video to Cloudinary CDN.
-  Returns the CDN URL of the uploaded video.
+  Returns the CDN URL of the uploaded video. If given, report is filled in
+  with details of how the video was processed.
+
+  threads caps the decoder, filter and encoder threads of each ffmpeg run
+  so concurrent batch jobs share a fixed core budget; None lets ffmpeg pick. Intermediates are
+  written to the job's scratch workspace, never next to the input.
   """
-  import sys
+  if report is None:
+    report = {}
+  with scratch_workspace(local_video_path, report) as workspace:
+    return _transcode_and_upload_video(local_video_path, threads, report, workspace)
+
+def _transcode_and_upload_video(local_video_path, threads, report, workspace):
   print(f"[DEBUG] Starting video processing for: {local_video_path}", file=sys.stderr)
+  thread_args = ['-threads', str(threads)] if threads else []
 
   # Validate input file
   if not os.path.exists(local_video_path):
@@ -45,6 +1728,7 @@ def process_and_upload_video(local_video_path):
 
   file_size = os.path.getsize(local_video_path)
   print(f"[DEBUG] Input file size: {file_size} bytes", file=sys.stderr)
+  report['input_bytes'] = file_size
 
   if file_size == 0:
     raise ValueError(f"Input video file is empty: {local_video_path}")
@@ -62,348 +1746,317 @@ def process_and_upload_video(local_video_path):
     else:
       print(f"[DEBUG] Unknown format or potentially corrupted header", file=sys.stderr)
 
-  # Quick validation using ffprobe
-  ffprobe_bin = os.path.join(os.path.dirname(__file__), '../bin/ffprobe')
-  if os.path.exists(ffprobe_bin):
-    try:
-      # First try with detailed output to see what ffprobe thinks
-      probe_cmd_detailed = [ffprobe_bin, '-v', 'error', '-show_format', '-show_streams', local_video_path]
-      probe_result = subprocess.run(probe_cmd_detailed, capture_output=True, text=True, timeout=10)
-
-      if probe_result.returncode != 0:
-        print(f"[WARNING] ffprobe detected issues with video file (exit code: {probe_result.returncode})", file=sys.stderr)
-        print(f"[WARNING] ffprobe stderr: {probe_result.stderr.strip()}", file=sys.stderr)
-        print(f"[WARNING] This file may be corrupted or have metadata issues", file=sys.stderr)
-      else:
-        print(f"[DEBUG] ffprobe validation successful", file=sys.stderr)
-        # Try to extract basic info
-        if "Duration:" in probe_result.stdout or "format_name" in probe_result.stdout:
-          print(f"[DEBUG] File appears to have valid video metadata", file=sys.stderr)
-    except (subprocess.TimeoutExpired, FileNotFoundError, PermissionError) as e:
-      print(f"[DEBUG] ffprobe validation skipped ({type(e).__name__}: {e})", file=sys.stderr)
-
-  compressed_path = local_video_path.replace('.mp4', '_compressed.mp4')
-  print(f"[DEBUG] Compressed video will be saved to: {compressed_path}", file=sys.stderr)
-  ffmpeg_bin = os.path.join(os.path.dirname(__file__), '../bin/ffmpeg')  # Check if this is an AV1 video that might need special handling
-  is_av1_video = False
-  if os.path.exists(ffprobe_bin):
-    try:
-      codec_check = subprocess.run([ffprobe_bin, '-v', 'quiet', '-select_streams', 'v:0', '-show_entries', 'stream=codec_name', '-of', 'csv=p=0', local_video_path], capture_output=True, text=True)
-      if codec_check.returncode == 0 and 'av1' in codec_check.stdout.lower():
-        is_av1_video = True
-        print(f"[DEBUG] Detected AV1 video codec", file=sys.stderr)
-    except:
-      pass
+  # Walk the MP4/MOV box structure (headers only) before spawning anything
+  with timed(report, 'container_scan'):
+    scan = scan_container(local_video_path)
+  if scan.is_mp4:
+    report['container_scan'] = scan.summary()
+    print(f"[DEBUG] Container scan ({scan.scan_seconds * 1e6:.0f}us): boxes {report['container_scan']['boxes']}"
+          f"{', moov at end' if scan.moov_at_end else ''}", file=sys.stderr)
+    for problem in scan.problems:
+      print(f"[WARNING] Container scan: {problem}", file=sys.stderr)
 
-  # First, try with appropriate decoding options
-  if is_av1_video:
-    # For AV1 videos, force software decoding and add specific options
-    compress_cmd = [
-      ffmpeg_bin,
-      '-hwaccel', 'none',  # Force software decoding
-      '-i', local_video_path,
-      '-c:v', 'libx264',  # Output codec
-      '-crf', '28',
-      '-preset', 'medium',  # Slower but more compatible for AV1
-      '-c:a', 'aac',  # Audio codec
-      '-movflags', '+faststart',  # Web optimization
-      '-pix_fmt', 'yuv420p',  # Ensure compatibility
-      compressed_path
-    ]
+  # Quick validation using ffprobe (one JSON pass, reused for every decision below)
+  ffprobe_bin = os.path.join(os.path.dirname(__file__), '../bin/ffprobe')
+  if scan.missing_moov:
+    # ffprobe can only say "moov atom not found"; go straight to recovery
+    media = None
   else:
-    # Standard compression for other codecs
-    compress_cmd = [
-      ffmpeg_bin, '-i', local_video_path,
-      '-c:v', 'libx264',  # Output codec
-      '-crf', '28',
-      '-preset', 'fast',
-      '-c:a', 'aac',  # Audio codec
-      '-movflags', '+faststart',  # Web optimization
-      '-pix_fmt', 'yuv420p',  # Ensure compatibility
-      compressed_path
-    ]
-
-  print(f"[DEBUG] Running ffmpeg command: {' '.join(compress_cmd)}", file=sys.stderr)
-
-  try:
-    subprocess.run(compress_cmd, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-    print(f"[DEBUG] FFmpeg compression completed successfully", file=sys.stderr)
-  except subprocess.CalledProcessError as e:
-    print(f"[DEBUG] FFmpeg failed with standard command, trying fallback options", file=sys.stderr)
-    print(f"[DEBUG] FFmpeg error: {e.stderr.decode() if e.stderr else 'No error details'}", file=sys.stderr)
+    with timed(report, 'probe'):
+      media = probe_media(local_video_path, ffprobe_bin)
+  if media is not None:
+    if not media.ok:
+      print(f"[WARNING] ffprobe detected issues with video file", file=sys.stderr)
+      print(f"[WARNING] ffprobe stderr: {media.error}", file=sys.stderr)
+      print(f"[WARNING] This file may be corrupted or have metadata issues", file=sys.stderr)
+    else:
+      print(f"[DEBUG] ffprobe validation successful: {media.container}, {media.video_codec} {media.width}x{media.height} {media.pix_fmt}, "
+            f"{media.duration:.2f}s, {media.bit_rate} b/s, audio {media.audio_codec or 'none'} {media.channel_layout}", file=sys.stderr)
 
-    # Check if this is an AV1 decoding issue
-    stderr_content = e.stderr.decode() if e.stderr else ''
-    if ('doesn\'t support hardware accelerated AV1 decoding' in stderr_content or
-        'Error submitting packet to decoder' in stderr_content or
-        'Failed to get pixel format' in stderr_content):
-      print(f"[DEBUG] Detected AV1 codec issues, trying alternative decoding approach", file=sys.stderr)
+  if media is not None and media.ok:
+    report['width'], report['height'] = media.display_size
+    report['duration'] = media.duration
 
-      # AV1-specific fallback with different options
-      try:
-        av1_fallback_cmd = [
-          ffmpeg_bin,
-          '-threads', '1',  # Single thread for stability
-          '-hwaccel', 'none',  # Force software decoding
-          '-i', local_video_path,
-          '-c:v', 'libx264',
-          '-crf', '28',
-          '-preset', 'ultrafast',  # Fastest preset for problematic AV1
-          '-c:a', 'aac',
-          '-ac', '2',  # Force stereo
-          '-ar', '44100',  # Force sample rate
-          '-movflags', '+faststart',
-          '-pix_fmt', 'yuv420p',
-          '-avoid_negative_ts', 'make_zero',
-          '-max_muxing_queue_size', '1024',
-          compressed_path
-        ]
-        print(f"[DEBUG] Attempting AV1 fallback: {' '.join(av1_fallback_cmd)}", file=sys.stderr)
-        subprocess.run(av1_fallback_cmd, check=True)
-        print(f"[DEBUG] AV1 fallback compression successful", file=sys.stderr)
-        return  # Success, exit the exception handler
-      except subprocess.CalledProcessError:
-        print(f"[DEBUG] AV1 fallback failed, trying standard repair approaches", file=sys.stderr)
-
-    # Check if this looks like a metadata corruption issue or missing moov atom
-    elif ('contradictionary STSC and STCO' in stderr_content or
-          'error reading header' in stderr_content or
-          'moov atom not found' in stderr_content):
-      if 'moov atom not found' in stderr_content:
-        print(f"[DEBUG] Detected missing moov atom (incomplete download), trying recovery", file=sys.stderr)
-        # For missing moov atom, try to scan for streams and rebuild metadata
-        recovery_cmd = [
-          ffmpeg_bin, '-analyzeduration', '2147483647', '-probesize', '2147483647',
-          '-i', local_video_path,
-          '-c:v', 'libx264', '-crf', '28', '-preset', 'ultrafast',
-          '-c:a', 'aac', '-movflags', '+faststart',
-          '-f', 'mp4', '-y',  # Force overwrite
-          compressed_path
-        ]
-        try:
-          print(f"[DEBUG] Attempting moov atom recovery: {' '.join(recovery_cmd)}", file=sys.stderr)
-          subprocess.run(recovery_cmd, check=True)
-          print(f"[DEBUG] Moov atom recovery successful", file=sys.stderr)
-          return  # Success, exit the exception handler
-        except subprocess.CalledProcessError:
-          print(f"[DEBUG] Moov atom recovery failed, file may be too corrupted", file=sys.stderr)
-      else:
-        print(f"[DEBUG] Detected MP4 metadata corruption, trying container remux first", file=sys.stderr)
+  compressed_path = workspace.file(os.path.splitext(os.path.basename(local_video_path))[0] + '_compressed.mp4')
+  report['poster_path'], report['strip_path'] = preview_paths(compressed_path)
+  print(f"[DEBUG] Compressed video will be saved to: {compressed_path}", file=sys.stderr)
+  ffmpeg_bin = os.path.join(os.path.dirname(__file__), '../bin/ffmpeg')
+  # Outputs that won't fit Cloudinary can stream straight to their
+  # large-file destination while encoding. With a size target only the plan
+  # can say that (most large inputs are encoded under the cap); without one
+  # the input size is the best guess.
+  if TARGET_SIZE_BYTES:
+    report['expected_output_bytes'] = plan_size_target(media)['predicted_bytes']
+  else:
+    report['expected_output_bytes'] = file_size
+  if streaming_enabled() and (report['expected_output_bytes'] or 0) > CLOUDINARY_MAX_BYTES:
+    with timed(report, 'stream_encode_upload'):
+      url = stream_encode_and_upload(local_video_path, compressed_path, ffmpeg_bin, media, scan, thread_args, report)
+    if url:
+      if not report.get('previews_inline'):
+        with timed(report, 'previews'):
+          extract_previews(local_video_path, ffmpeg_bin, media, report['poster_path'], report['strip_path'], thread_args)
+      return url
 
-        # Try to remux the container without re-encoding to fix metadata
-        try:
-          remux_path = local_video_path.replace('.mp4', '_remuxed.mp4')
-          remux_cmd = [
-            ffmpeg_bin, '-i', local_video_path,
-            '-c', 'copy',  # Copy streams without re-encoding
-            '-avoid_negative_ts', 'make_zero',
-            '-fflags', '+genpts',
-            '-map_metadata', '-1',  # Strip problematic metadata
-            remux_path
-          ]
-          print(f"[DEBUG] Attempting container remux: {' '.join(remux_cmd)}", file=sys.stderr)
-          subprocess.run(remux_cmd, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-          # Now try to compress the remuxed file
-          remux_compress_cmd = [
-            ffmpeg_bin, '-i', remux_path,
-            '-c:v', 'libx264', '-crf', '28', '-preset', 'fast',
-            '-c:a', 'aac', '-movflags', '+faststart', '-pix_fmt', 'yuv420p',
-            compressed_path
-          ]
-          print(f"[DEBUG] Compressing remuxed file: {' '.join(remux_compress_cmd)}", file=sys.stderr)
-          subprocess.run(remux_compress_cmd, check=True)
-
-          # Clean up remuxed file
-          os.remove(remux_path)
-          print(f"[DEBUG] Container remux and compression successful", file=sys.stderr)
-          # If we get here, the remux worked, so we can skip other fallbacks
-          return  # Exit the except block successfully
-
-        except subprocess.CalledProcessError:
-          print(f"[DEBUG] Container remux failed, trying repair approach", file=sys.stderr)
-        # Continue to the repair fallback below
-
-    # First fallback: try to repair the file and then compress
+  report['encode_path'] = 'transcode'
+  if is_web_ready(media, file_size, scan):
+    # Already H.264/AAC/yuv420p at a sane size: just move the moov atom up front
+    remux_cmd = [ffmpeg_bin, '-y', '-i', local_video_path, '-c', 'copy', '-movflags', '+faststart', compressed_path]
+    print(f"[DEBUG] Input is web-ready, remuxing without re-encode: {' '.join(remux_cmd)}", file=sys.stderr)
     try:
-      repair_cmd = [
-        ffmpeg_bin, '-err_detect', 'ignore_err', '-i', local_video_path,
-        '-c', 'copy', '-f', 'mp4',
-        local_video_path.replace('.mp4', '_repaired.mp4')
-      ]
-      print(f"[DEBUG] Attempting to repair video: {' '.join(repair_cmd)}", file=sys.stderr)
-      subprocess.run(repair_cmd, check=True, stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-
-      # Now try to compress the repaired file
-      repaired_path = local_video_path.replace('.mp4', '_repaired.mp4')
-      repair_compress_cmd = [
-        ffmpeg_bin, '-i', repaired_path,
-        '-c:v', 'libx264',
-        '-crf', '28',
-        '-preset', 'fast',
-        '-c:a', 'aac',
-        '-movflags', '+faststart',
-        '-pix_fmt', 'yuv420p',
-        compressed_path
-      ]
-      print(f"[DEBUG] Compressing repaired video: {' '.join(repair_compress_cmd)}", file=sys.stderr)
-      subprocess.run(repair_compress_cmd, check=True)
-
-      # Clean up repaired file
-      os.remove(repaired_path)
-      print(f"[DEBUG] Video repair and compression successful", file=sys.stderr)
-
-    except subprocess.CalledProcessError:
-      print(f"[DEBUG] Video repair failed, trying aggressive fallback", file=sys.stderr)
-
-      # Last resort: aggressive compatibility options
-      fallback_cmd = [
-        ffmpeg_bin, '-err_detect', 'ignore_err', '-i', local_video_path,
-        '-c:v', 'libx264',
-        '-crf', '28',
-        '-preset', 'ultrafast',
-        '-c:a', 'aac',
-        '-movflags', '+faststart',
-        '-pix_fmt', 'yuv420p',
-        '-avoid_negative_ts', 'make_zero',
-        '-fflags', '+genpts+discardcorrupt',
-        '-max_muxing_queue_size', '1024',
-        '-fps_mode', 'cfr',  # Constant frame rate (updated from deprecated -vsync)
-        compressed_path
-      ]
+      with timed(report, 'encode:remux'):
+        run_ffmpeg(remux_cmd, stage='encode:remux', duration=media.duration)
+      report['encode_path'] = 'remux'
+      print(f"[DEBUG] Remux fast path completed successfully", file=sys.stderr)
+    except subprocess.CalledProcessError as e:
+      print(f"[DEBUG] Remux fast path failed, falling back to full encode: {e.stderr.decode(errors='replace') if e.stderr else 'No error details'}", file=sys.stderr)
+  if report['encode_path'] != 'remux':
+    encode_with_plan(local_video_path, compressed_path, ffmpeg_bin, media, scan, thread_args, report)
+  if not report.get('previews_inline'):
+    with timed(report, 'previews'):
+      extract_previews(compressed_path, ffmpeg_bin, media, report['poster_path'], report['strip_path'], thread_args)
 
-      print(f"[DEBUG] Running aggressive fallback: {' '.join(fallback_cmd)}", file=sys.stderr)
-      try:
-        subprocess.run(fallback_cmd, check=True)
-      except subprocess.CalledProcessError:
-        print(f"[DEBUG] Aggressive fallback failed, trying raw stream extraction", file=sys.stderr)
-
-        # Final attempt: try to extract raw streams and rebuild
-        raw_extract_cmd = [
-          ffmpeg_bin, '-analyzeduration', '2147483647', '-probesize', '2147483647',
-          '-err_detect', 'ignore_err', '-i', local_video_path,
-          '-map', '0', '-ignore_unknown',
-          '-c:v', 'libx264', '-crf', '28', '-preset', 'ultrafast',
-          '-c:a', 'aac', '-ac', '2', '-ar', '44100',
-          '-pix_fmt', 'yuv420p',
-          '-f', 'mp4', '-movflags', '+faststart',
-          '-avoid_negative_ts', 'make_zero',
-          '-fflags', '+genpts+discardcorrupt+igndts',
-          '-fps_mode', 'cfr',
-          '-max_muxing_queue_size', '4096',
-          '-max_interleave_delta', '0',
-          compressed_path
-        ]
-
-        print(f"[DEBUG] Attempting raw stream extraction: {' '.join(raw_extract_cmd)}", file=sys.stderr)
-        try:
-          subprocess.run(raw_extract_cmd, check=True)
-        except subprocess.CalledProcessError as final_error:
-          print(f"[ERROR] All video repair attempts failed. File appears to be completely corrupted.", file=sys.stderr)
-          print(f"[ERROR] Final error: {final_error.stderr.decode() if hasattr(final_error, 'stderr') and final_error.stderr else 'No details available'}", file=sys.stderr)
-
-          # Check if this is a seed operation and we should skip this file
-          file_name = os.path.basename(local_video_path)
-          if '_seed.mp4' in file_name:
-            print(f"[WARNING] Skipping corrupted seed file: {file_name}", file=sys.stderr)
-            # Return a placeholder or None to indicate failure
-            raise ValueError(f"Video file {file_name} is corrupted and cannot be processed. Consider removing it from the seed data.")
-          else:
-            # Re-raise the error for non-seed files
-            raise
   # Check file size before uploading
-  file_size = os.path.getsize(compressed_path)
+  with timed(report, 'size_check'):
+    file_size = os.path.getsize(compressed_path)
   print(f"[DEBUG] Compressed file size: {file_size} bytes", file=sys.stderr)
-  max_size = 100 * 1024 * 1024  # 100MB in bytes
-  if file_size > max_size:
-    # Debug print for file existence
-    print(f"[DEBUG] Checking file existence: {compressed_path} (exists: {os.path.isfile(compressed_path)})", file=sys.stderr)
-    # Ensure file exists before uploading
-    if not os.path.isfile(compressed_path):
-      print(f"[ERROR] File not found for large video handling: {compressed_path}", file=sys.stderr)
-      raise FileNotFoundError(f"File not found: {compressed_path}")
-    # Check environment - check multiple possible env vars and production indicators
-    env = os.getenv('NODE_ENV') or os.getenv('ENVIRONMENT') or os.getenv('ENV') or 'development'
-
-    # Also check for production indicators
-    database_url = os.getenv('DATABASE_URL', '')
-    is_prod_db = 'prisma.io' in database_url or 'postgres://' in database_url
-
-    print(f"[DEBUG] NODE_ENV from env: {os.getenv('NODE_ENV')}", file=sys.stderr)
-    print(f"[DEBUG] Environment detected: {env}", file=sys.stderr)
-    print(f"[DEBUG] Database URL contains production indicators: {is_prod_db}", file=sys.stderr)
-
-    # Force production if we detect production database
-    if is_prod_db and env != 'production':
-        env = 'production'
-        print(f"[DEBUG] Overriding environment to production based on database", file=sys.stderr)
-
-    if env == 'production':
-      # Upload to Google Cloud Storage
-      gcs_url = upload_video_to_gcs(compressed_path, bucket_name='mochlist', folder='videos')
-      print(f"[DEBUG] File too large for Cloudinary. Uploaded to GCS: {gcs_url}", file=sys.stderr)
-      return gcs_url
-    else:
-      # Save to /public/videos in development
-      import shutil
-      videos_dir = os.path.join(os.path.dirname(__file__), '../../public/videos')
-      os.makedirs(videos_dir, exist_ok=True)
-      dest_path = os.path.join(videos_dir, os.path.basename(compressed_path))
-      shutil.move(compressed_path, dest_path)
-      public_path = f"/videos/{os.path.basename(compressed_path)}"
-      print(f"[DEBUG] Moved large video to: {dest_path}", file=sys.stderr)
-      print(f"[DEBUG] Returning public path: {public_path}", file=sys.stderr)
-      return public_path
+  report['output_bytes'] = file_size
+  if report.get('size_target'):
+    report['predicted_bytes'] = report['size_target']['predicted_bytes']
+    print(f"[DEBUG] Size target check: predicted {report['predicted_bytes']} bytes, actual {file_size} bytes", file=sys.stderr)
+  with timed(report, 'upload'):
+    return deliver_video(compressed_path, file_size, report)
+
+def forced_backend():
+  """
+  The backend named by VIDEO_CDN_STORAGE_BACKEND, or None. Raises
+  ValueError for a name that isn't registered, so a typo fails the job
+  before any ffmpeg work rather than at delivery.
+  """
+  forced = os.getenv('VIDEO_CDN_STORAGE_BACKEND')
+  if forced and forced not in STORAGE_BACKENDS:
+    raise ValueError(f"Unknown storage backend '{forced}' in VIDEO_CDN_STORAGE_BACKEND "
+                     f"(known: {', '.join(sorted(STORAGE_BACKENDS))})")
+  return forced or None
+
+def select_backend(file_size):
+  """
+  The routing decision: VIDEO_CDN_STORAGE_BACKEND if set (e.g. 'fake'),
+  otherwise Cloudinary up to its cap and GCS (production) or public/videos
+  (development) above it.
+  """
+  forced = forced_backend()
+  if forced:
+    return forced
+  if file_size > CLOUDINARY_MAX_BYTES:
+    return 'gcs' if detect_environment() == 'production' else 'public'
+  return 'cloudinary'
+
+def deliver_video(compressed_path, file_size, report):
+  """
+  Sends the compressed video to the backend chosen by select_backend.
+  Returns the URL and records the destination in report.
+  """
+  # Debug print for file existence
+  print(f"[DEBUG] Checking file existence: {compressed_path} (exists: {os.path.isfile(compressed_path)})", file=sys.stderr)
+  # Ensure file exists before uploading
+  if not os.path.isfile(compressed_path):
+    print(f"[ERROR] File not found for upload: {compressed_path}", file=sys.stderr)
+    raise FileNotFoundError(f"File not found: {compressed_path}")
+  destination = select_backend(file_size)
+  print(f"[DEBUG] Delivering {file_size} bytes via the '{destination}' backend", file=sys.stderr)
   try:
-    response = cloudinary.uploader.upload(
-      compressed_path,
-      resource_type="video",
-      folder="PlaylistViewer"
-    )
-    print(f"[DEBUG] Cloudinary upload response: {response}", file=sys.stderr)
-    os.remove(compressed_path)
-    print(f"[DEBUG] Removed temporary compressed file: {compressed_path}", file=sys.stderr)
-    return response['secure_url']
+    url = get_backend(destination).upload_video(compressed_path, stats=report)
   except Exception as e:
-    import shutil
     err_str = str(e)
-    print(f"[DEBUG] Cloudinary upload failed: {err_str}", file=sys.stderr)
-    # If error is 413 or mentions 'Entity Too Large', move file to /public/videos
-    if '413' in err_str or 'Entity Too Large' in err_str:
-      videos_dir = os.path.join(os.path.dirname(__file__), '../../public/videos')
-      os.makedirs(videos_dir, exist_ok=True)
-      dest_path = os.path.join(videos_dir, os.path.basename(compressed_path))
-      shutil.move(compressed_path, dest_path)
-      public_path = f"/videos/{os.path.basename(compressed_path)}"
-      print(f"[DEBUG] Moved large video to: {dest_path}", file=sys.stderr)
-      print(f"[DEBUG] Returning public path for large file fallback: {public_path}", file=sys.stderr)
-      return public_path
-    else:
-      # Clean up temp file if not a size error
-      os.remove(compressed_path)
-      print(f"[DEBUG] Removed temporary compressed file: {compressed_path}", file=sys.stderr)
+    print(f"[DEBUG] {destination} upload failed: {err_str}", file=sys.stderr)
+    # If Cloudinary says 413 or 'Entity Too Large', move file to /public/videos
+    if destination != 'cloudinary' or not ('413' in err_str or 'Entity Too Large' in err_str):
       raise
+    destination = 'public'
+    url = get_backend(destination).upload_video(compressed_path, stats=report)
+    print(f"[DEBUG] Returning public path for large file fallback: {url}", file=sys.stderr)
+  report['destination'] = destination
+  return url
+
+# Upload tuning. GCS resumable chunks must be a multiple of 256 KiB.
+UPLOAD_CHUNK_BYTES = int(os.getenv('VIDEO_CDN_UPLOAD_CHUNK_MB') or 8) * 1024 * 1024
+UPLOAD_MAX_RETRIES = int(os.getenv('VIDEO_CDN_UPLOAD_MAX_RETRIES') or 5)
+GCS_PARALLEL_THRESHOLD_BYTES = int(os.getenv('VIDEO_CDN_GCS_PARALLEL_THRESHOLD_MB') or 256) * 1024 * 1024
+GCS_PARALLEL_WORKERS = int(os.getenv('VIDEO_CDN_GCS_PARALLEL_WORKERS') or 8)
+
+_gcs_client = None
+
+def get_gcs_client():
+    """
+    Returns a process-wide GCS client so worker mode doesn't rebuild the
+    client (and re-resolve credentials) for every upload. The SDK is only
+    imported here, on first use. With STORAGE_EMULATOR_HOST set (local fake
+    server) it uses anonymous credentials.
+    """
+    global _gcs_client
+    if _gcs_client is None:
+        from google.cloud import storage
+        if os.getenv('STORAGE_EMULATOR_HOST'):
+            from google.auth.credentials import AnonymousCredentials
+            _gcs_client = storage.Client(project=os.getenv('GOOGLE_CLOUD_PROJECT') or 'local', credentials=AnonymousCredentials())
+        else:
+            _gcs_client = storage.Client()
+    return _gcs_client
+
+_cloudinary_uploader = None
+
+def load_cloudinary():
+    """
+    Imports and configures the Cloudinary SDK on first use and returns its
+    uploader module.
+    """
+    global _cloudinary_uploader
+    if _cloudinary_uploader is None:
+        import cloudinary
+        import cloudinary.uploader
+        cloudinary.config(
+            cloud_name=os.getenv('CLOUDINARY_CLOUD_NAME'),
+            api_key=os.getenv('CLOUDINARY_API_KEY'),
+            api_secret=os.getenv('CLOUDINARY_API_SECRET'),
+            # Point at a local fake upload server in tests
+            upload_prefix=os.getenv('CLOUDINARY_UPLOAD_PREFIX') or None
+        )
+        _cloudinary_uploader = cloudinary.uploader
+    return _cloudinary_uploader
+
+def _backoff(attempt):
+    time.sleep(min(30, 0.5 * (2 ** attempt)))
+
+def _acknowledged_offset(response_headers):
+    """
+    Next byte to send after a 308 from a resumable session: one past the end
+    of its Range header ("bytes=0-N"), or 0 if nothing was persisted yet.
+    """
+    byte_range = response_headers.get('Range')
+    if not byte_range:
+        return 0
+    return int(byte_range.rsplit('-', 1)[1]) + 1
+
+def _put_session(session_url, data, content_range):
+    """
+    PUTs one chunk to a resumable session. Returns (status, headers, body);
+    308 (resume incomplete) is a normal answer, not an error.
+    """
+    import urllib.request
+    request = urllib.request.Request(session_url, data=data, method='PUT',
+                                     headers={'Content-Range': content_range, 'Content-Length': str(len(data))})
+    try:
+        with urllib.request.urlopen(request, timeout=120) as response:
+            return response.status, response.headers, response.read()
+    except urllib.error.HTTPError as e:
+        if e.code == 308:
+            return 308, e.headers, b''
+        raise
+
+def upload_stream_to_session(session_url, stream, chunk_size=UPLOAD_CHUNK_BYTES, max_retries=UPLOAD_MAX_RETRIES, stats=None):
+    """
+    Streams a readable binary stream (file or pipe) into a GCS resumable
+    upload session in chunk_size pieces. The total size is only declared
+    with the last chunk, so the stream may still be growing. After a failed
+    chunk it asks the session how much it has and resumes from the last
+    acknowledged offset; unacknowledged bytes are kept in memory for that.
+    """
+    offset = 0  # Session offset of pending[0]
+    pending = bytearray()
+    eof = False
+    failures = 0
+    while True:
+        while not eof and len(pending) < chunk_size:
+            data = stream.read(chunk_size - len(pending))
+            if data:
+                pending.extend(data)
+            else:
+                eof = True
+        final = eof and len(pending) <= chunk_size
+        total = str(offset + len(pending)) if final else '*'
+        send = bytes(pending[:chunk_size])
+        if send:
+            content_range = f"bytes {offset}-{offset + len(send) - 1}/{total}"
+        else:
+            content_range = f"bytes */{total}"
+        acknowledged = offset
+        try:
+            status, headers, body = _put_session(session_url, send, content_range)
+            if status in (200, 201):
+                return json.loads(body or b'{}')
+            acknowledged = _acknowledged_offset(headers)
+            if acknowledged > offset:
+                failures = 0
+            else:
+                failures += 1
+                if failures > max_retries:
+                    raise IOError(f"Resumable session made no progress past offset {offset}")
+        except (urllib.error.URLError, OSError) as e:
+            code = getattr(e, 'code', None)
+            if code is not None and code < 500 and code != 429:
+                raise
+            failures += 1
+            if failures > max_retries:
+                raise
+            print(f"[DEBUG] Resumable chunk at offset {offset} failed ({e}), retry {failures}/{max_retries}", file=sys.stderr)
+            count(stats, 'upload_retries')
+            _backoff(failures)
+            # Ask the session where it actually got to before resending
+            try:
+                status, headers, body = _put_session(session_url, b'', f"bytes */{total}")
+                if status in (200, 201):
+                    return json.loads(body or b'{}')
+                acknowledged = _acknowledged_offset(headers)
+            except (urllib.error.URLError, OSError):
+                pass
+        acknowledged = max(offset, min(acknowledged, offset + len(pending)))
+        del pending[:acknowledged - offset]
+        offset = acknowledged
+
+def upload_file_to_session(session_url, local_path, chunk_size=UPLOAD_CHUNK_BYTES, max_retries=UPLOAD_MAX_RETRIES, stats=None):
+    """
+    Uploads local_path into a GCS resumable upload session (see
+    upload_stream_to_session).
+    """
+    with open(local_path, 'rb') as f:
+        return upload_stream_to_session(session_url, f, chunk_size=chunk_size, max_retries=max_retries, stats=stats)
 
-def upload_video_to_gcs(local_path, bucket_name='mochlist', folder='videos'):
+def upload_video_to_gcs(local_path, bucket_name='mochlist', folder='videos', content_type='video/mp4', stats=None):
     """
     Uploads a local file to Google Cloud Storage and returns the public URL.
+    Files above GCS_PARALLEL_THRESHOLD_BYTES go up as concurrent parts; the
+    rest use a chunked resumable session.
     """
-    import sys
     print(f"[DEBUG] Starting upload_video_to_gcs for: {local_path}", file=sys.stderr)
     print(f"[DEBUG] Checking file existence: {local_path} (exists: {os.path.isfile(local_path)})", file=sys.stderr)
     if not os.path.isfile(local_path):
         print(f"[ERROR] File not found: {local_path}", file=sys.stderr)
         raise FileNotFoundError(f"File not found: {local_path}")
     try:
-        print(f"[DEBUG] Initializing GCS client...", file=sys.stderr)
-        client = storage.Client()
+        client = get_gcs_client()
         print(f"[DEBUG] Getting bucket: {bucket_name}", file=sys.stderr)
         bucket = client.bucket(bucket_name)
         blob_name = os.path.basename(local_path)
         print(f"[DEBUG] Creating blob: {blob_name}", file=sys.stderr)
-        blob = bucket.blob(blob_name)
-        print(f"[DEBUG] Uploading file to GCS...", file=sys.stderr)
-        blob.upload_from_filename(local_path)
+        blob = bucket.blob(blob_name, chunk_size=UPLOAD_CHUNK_BYTES)
+        file_size = os.path.getsize(local_path)
+        uploaded = False
+        if file_size >= GCS_PARALLEL_THRESHOLD_BYTES:
+            try:
+                from google.cloud.storage import transfer_manager
+                print(f"[DEBUG] Uploading file to GCS in parallel parts ({GCS_PARALLEL_WORKERS} workers)...", file=sys.stderr)
+                transfer_manager.upload_chunks_concurrently(
+                    local_path, blob, content_type=content_type,
+                    chunk_size=max(UPLOAD_CHUNK_BYTES, 32 * 1024 * 1024),
+                    max_workers=GCS_PARALLEL_WORKERS)
+                uploaded = True
+            except ImportError:
+                print(f"[DEBUG] Parallel uploads need a newer google-cloud-storage, using a resumable session", file=sys.stderr)
+        if not uploaded:
+            print(f"[DEBUG] Uploading file to GCS via resumable session ({UPLOAD_CHUNK_BYTES} byte chunks)...", file=sys.stderr)
+            session_url = blob.create_resumable_upload_session(content_type=content_type, size=file_size)
+            upload_file_to_session(session_url, local_path, stats=stats)
         public_url = blob.public_url
         print(f"[DEBUG] Uploaded to GCS. Public URL: {public_url}", file=sys.stderr)
         return public_url
@@ -411,24 +2064,374 @@ def upload_video_to_gcs(local_path, bucket_name='mochlist', folder='videos'):
         print(f"[ERROR] Exception during GCS upload: {e}", file=sys.stderr)
         raise
 
-if __name__ == "__main__":
-  import sys
+def upload_image(local_path, destination):
+    """
+    Puts a poster/preview image where its video went and returns its URL.
+    The local file is left for the caller to remove.
+    """
+    return get_backend(destination).upload_image(local_path)
+
+# Client errors a retry can't fix. Cloudinary raises these statuses as
+# cloudinary.exceptions types and carries no status code on the exception.
+PERMANENT_UPLOAD_STATUSES = (400, 401, 403, 413)
+PERMANENT_CLOUDINARY_ERRORS = ('BadRequest', 'AuthorizationRequired', 'NotAllowed')
+
+def _is_permanent_upload_error(error):
+    """
+    True if retrying an upload can't help: a 400/401/403/413 status on the
+    exception (http_code, or urllib's code), one of Cloudinary's
+    bad-request/auth exception types, or the 413 text of a proxy's reply.
+    """
+    status = getattr(error, 'http_code', None) or getattr(error, 'code', None)
+    if isinstance(status, int) and status in PERMANENT_UPLOAD_STATUSES:
+        return True
+    if type(error).__module__ == 'cloudinary.exceptions' and type(error).__name__ in PERMANENT_CLOUDINARY_ERRORS:
+        return True
+    err_str = str(error)
+    return '413' in err_str or 'Entity Too Large' in err_str
+
+def upload_video_to_cloudinary(local_path, folder="PlaylistViewer", chunk_size=UPLOAD_CHUNK_BYTES, max_retries=UPLOAD_MAX_RETRIES, stats=None):
+    """
+    Chunked Cloudinary upload (the same protocol as uploader.upload_large).
+    Each chunk is retried on its own, so a dropped connection resends one
+    chunk rather than the whole file, and a 413 surfaces on the first chunk
+    instead of after the full body.
+    """
+    uploader = load_cloudinary()
+    total = os.path.getsize(local_path)
+    upload_id = uuid.uuid4().hex
+    options = {'resource_type': 'video', 'folder': folder}
+    response = None
+    offset = 0
+    with open(local_path, 'rb') as f:
+        while True:
+            data = f.read(chunk_size)
+            headers = {
+                'Content-Range': f"bytes {offset}-{offset + len(data) - 1}/{total}",
+                'X-Unique-Upload-Id': upload_id,
+            }
+            for attempt in range(max_retries + 1):
+                try:
+                    response = uploader.upload_large_part((os.path.basename(local_path), data), http_headers=headers, **options)
+                    break
+                except Exception as e:
+                    if _is_permanent_upload_error(e) or attempt == max_retries:
+                        raise
+                    print(f"[DEBUG] Cloudinary chunk at offset {offset} failed ({e}), retry {attempt + 1}/{max_retries}", file=sys.stderr)
+                    count(stats, 'upload_retries')
+                    _backoff(attempt + 1)
+            if response.get('public_id'):
+                options['public_id'] = response['public_id']
+            offset += len(data)
+            if offset >= total:
+                break
+    return response
+
+# Storage backends by name. A backend is constructed, and its SDK imported,
+# only when a routing decision first selects it, so dev runs that end in
+# public/videos and inputs that fail validation never load Cloudinary or GCS.
+STORAGE_BACKENDS = {}
+_backend_instances = {}
+
+def storage_backend(name):
+    """
+    Class decorator registering a storage backend under name. A backend
+    provides upload_video(local_path, stats=None) and upload_image(local_path),
+    both returning the public URL.
+    """
+    def register(cls):
+        cls.name = name
+        STORAGE_BACKENDS[name] = cls
+        return cls
+    return register
+
+def get_backend(name):
+    """
+    Returns the process-wide instance of the named backend, creating it on
+    first use.
+    """
+    if name not in _backend_instances:
+        if name not in STORAGE_BACKENDS:
+            raise ValueError(f"Unknown storage backend '{name}' (known: {', '.join(sorted(STORAGE_BACKENDS))})")
+        _backend_instances[name] = STORAGE_BACKENDS[name]()
+    return _backend_instances[name]
+
+@storage_backend('cloudinary')
+class CloudinaryBackend:
+    """
+    Cloudinary CDN, for files up to CLOUDINARY_MAX_BYTES.
+    """
+
+    def __init__(self):
+        self.uploader = load_cloudinary()
+
+    def upload_video(self, local_path, stats=None):
+        response = upload_video_to_cloudinary(local_path, folder="PlaylistViewer", stats=stats)
+        print(f"[DEBUG] Cloudinary upload complete: {response.get('secure_url')} ({response.get('bytes')} bytes)", file=sys.stderr)
+        return response['secure_url']
+
+    def upload_image(self, local_path):
+        response = self.uploader.upload(local_path, resource_type='image', folder='PlaylistViewer')
+        return response['secure_url']
+
+@storage_backend('gcs')
+class GcsBackend:
+    """
+    The mochlist GCS bucket, for large files in production.
+    """
+    bucket_name = 'mochlist'
+    folder = 'videos'
+
+    def __init__(self):
+        get_gcs_client()
+
+    def upload_video(self, local_path, stats=None):
+        return upload_video_to_gcs(local_path, bucket_name=self.bucket_name, folder=self.folder, stats=stats)
+
+    def upload_image(self, local_path):
+        return upload_video_to_gcs(local_path, bucket_name=self.bucket_name, folder=self.folder, content_type='image/jpeg')
+
+@storage_backend('public')
+class PublicDirBackend:
+    """
+    The Next.js app's public/videos directory, for large files in
+    development. Returns site-relative /videos/ paths.
+    """
+
+    def upload_video(self, local_path, stats=None):
+        os.makedirs(PUBLIC_VIDEOS_DIR, exist_ok=True)
+        dest_path = os.path.join(PUBLIC_VIDEOS_DIR, os.path.basename(local_path))
+        shutil.move(local_path, dest_path)
+        print(f"[DEBUG] Moved large video to: {dest_path}", file=sys.stderr)
+        return f"/videos/{os.path.basename(local_path)}"
+
+    def upload_image(self, local_path):
+        os.makedirs(PUBLIC_VIDEOS_DIR, exist_ok=True)
+        shutil.copyfile(local_path, os.path.join(PUBLIC_VIDEOS_DIR, os.path.basename(local_path)))
+        return f"/videos/{os.path.basename(local_path)}"
+
+@storage_backend('fake')
+class FakeBackend:
+    """
+    Copies uploads into VIDEO_CDN_FAKE_STORAGE_DIR and returns file:// URLs,
+    for local runs and tests without credentials or network.
+    """
+
+    def __init__(self):
+        self.directory = os.getenv('VIDEO_CDN_FAKE_STORAGE_DIR') or os.path.join(tempfile.gettempdir(), 'video_cdn_fake_storage')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def upload_video(self, local_path, stats=None):
+        dest_path = os.path.join(self.directory, os.path.basename(local_path))
+        shutil.copyfile(local_path, dest_path)
+        return f"file://{os.path.abspath(dest_path)}"
+
+    def upload_image(self, local_path):
+        return self.upload_video(local_path)
+
+def exit_code_for_error(error):
+  """
+  Maps an exception raised by process_and_upload_video to the CLI exit code
+  the Node.js side expects: 3 for corrupted files, 2 for everything else.
+  """
+  if "corrupted and cannot be processed" in str(error):
+    return 3  # Exit code 3 for corrupted files
+  return 2  # Exit code 2 for other errors
+
+def run_job(job):
+  """
+  Runs a single worker job ({"id": ..., "path": ...}) and returns a JSON-able
+  result dict. Errors are reported in the result instead of being raised so one
+  bad job never takes the worker down.
+  """
+  job_id = job.get('id') if isinstance(job, dict) else None
+  try:
+    if not isinstance(job, dict) or not job.get('path'):
+      raise ValueError("Job must be an object with a 'path' field")
+    result = process_video(job['path'], threads=job.get('threads'))
+    return {'id': job_id, 'ok': True, **result}
+  except Exception as e:
+    print(f"Error: {e}", file=sys.stderr)
+    return {'id': job_id, 'ok': False, 'error': str(e), 'exit_code': exit_code_for_error(e)}
+
+def available_cpus():
+  """
+  Number of CPUs this process may run on (respects affinity/cgroup pinning).
+  """
   try:
-    if len(sys.argv) < 2:
-      print("Usage: python video_cdn_helper.py <video_path>", file=sys.stderr)
-      sys.exit(1)
-    video_path = sys.argv[1]
+    return len(os.sched_getaffinity(0))
+  except AttributeError:
+    return os.cpu_count() or 1
+
+def plan_batch(job_count, cpu_budget=None, max_workers=None):
+  """
+  Splits a fixed core budget between concurrent ffmpeg jobs.
+  Returns (workers, threads_per_job) so that workers * threads <= budget.
+  """
+  if cpu_budget is None:
+    cpu_budget = int(os.getenv('VIDEO_CDN_CPU_BUDGET') or available_cpus())
+  cpu_budget = max(1, cpu_budget)
+  # libx264 stops scaling well past a few threads, so by default favour
+  # more concurrent files at ~2 threads each over one wide encode.
+  if max_workers is None:
+    max_workers = max(1, cpu_budget // 2)
+  workers = max(1, min(job_count, max_workers, cpu_budget))
+  threads_per_job = max(1, cpu_budget // workers)
+  return workers, threads_per_job
+
+def _batch_job(path, threads):
+  return run_job({'id': path, 'path': path, 'threads': threads})
+
+def process_videos_batch(paths, cpu_budget=None, max_workers=None):
+  """
+  Processes many videos on a process pool. Each ffmpeg run gets its share of
+  the core budget via -threads. Returns one result dict per input path, in
+  input order; a failing file never aborts the rest of the batch.
+  """
+  from concurrent.futures import ProcessPoolExecutor
+  if not paths:
+    return []
+  workers, threads = plan_batch(len(paths), cpu_budget, max_workers)
+  print(f"[DEBUG] Batch of {len(paths)} videos: {workers} workers x {threads} threads", file=sys.stderr)
+  results = []
+  with ProcessPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(_batch_job, path, threads) for path in paths]
+    for path, future in zip(paths, futures):
+      try:
+        results.append(future.result())
+      except Exception as e:
+        # Worker process died (e.g. OOM-killed); report it like any other failure
+        results.append({'id': path, 'ok': False, 'error': str(e), 'exit_code': exit_code_for_error(e)})
+  return results
+
+def serve_lines(reader, writer):
+  """
+  Reads JSON-lines jobs from reader and writes one JSON result line per job to
+  writer. Returns when reader hits EOF.
+  """
+  for line in reader:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      job = json.loads(line)
+    except ValueError as e:
+      result = {'id': None, 'ok': False, 'error': f"Invalid job JSON: {e}", 'exit_code': 2}
+    else:
+      if isinstance(job, dict) and job.get('progress'):
+        # Progress events share the result stream, tagged with the job id
+        def write_progress(event, job_id=job.get('id')):
+          writer.write(json.dumps({'id': job_id, 'event': 'progress', **event}) + '\n')
+          writer.flush()
+        set_progress_listener(write_progress)
+      try:
+        result = run_job(job)
+      finally:
+        set_progress_listener(None)
+    writer.write(json.dumps(result) + '\n')
+    writer.flush()
+
+def run_stdin_worker():
+  """
+  Long-lived worker on stdin/stdout. .env is loaded once at import, and each
+  storage backend (SDK, config, client) stays warm after its first job.
+  """
+  # Keep the protocol streams private: ffmpeg children inherit fd 0/1, and an
+  # inherited stdin would let ffmpeg swallow queued jobs.
+  reader = os.fdopen(os.dup(0), 'r')
+  writer = os.fdopen(os.dup(1), 'w')
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.close(devnull)
+  os.dup2(2, 1)
+  sys.stdout = sys.stderr
+  print(f"[DEBUG] Worker ready on stdin", file=sys.stderr)
+  serve_lines(reader, writer)
+
+def run_socket_worker(socket_path):
+  """
+  Long-lived worker on a local Unix socket. Connections are served one at a
+  time; each connection may send any number of JSON-lines jobs. A client
+  can have any file the worker can read published, so the socket is
+  owner-only (0600). Only a stale socket is replaced at socket_path;
+  anything else there is an error.
+  """
+  try:
+    if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+      raise FileExistsError(f"{socket_path} exists and is not a socket; refusing to replace it")
+    os.remove(socket_path)
+  except FileNotFoundError:
+    pass
+  devnull = os.open(os.devnull, os.O_RDONLY)
+  os.dup2(devnull, 0)
+  os.close(devnull)
+  server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  # No window where the socket exists with umask permissions
+  old_umask = os.umask(0o177)
+  try:
+    server.bind(socket_path)
+  finally:
+    os.umask(old_umask)
+  os.chmod(socket_path, 0o600)
+  server.listen()
+  print(f"[DEBUG] Worker listening on {socket_path}", file=sys.stderr)
+  try:
+    while True:
+      conn, _ = server.accept()
+      with conn, conn.makefile('r') as reader, conn.makefile('w') as writer:
+        try:
+          serve_lines(reader, writer)
+        except (BrokenPipeError, ConnectionResetError) as e:
+          print(f"[DEBUG] Worker client disconnected: {e}", file=sys.stderr)
+  finally:
+    server.close()
+    if os.path.exists(socket_path):
+      os.remove(socket_path)
+
+def main(argv):
+  if '--progress' in argv:
+    argv = [arg for arg in argv if arg != '--progress']
+    set_progress_listener(lambda event: print(f"[PROGRESS] {json.dumps(event)}", file=sys.stderr, flush=True))
+  if len(argv) >= 1 and argv[0] == '--worker':
+    run_stdin_worker()
+    return 0
+  if len(argv) >= 1 and argv[0] == '--batch':
+    results = process_videos_batch(argv[1:])
+    for result in results:
+      print(json.dumps(result))
+    return 0 if all(result['ok'] for result in results) else 2
+  if len(argv) >= 2 and argv[0] == '--socket':
+    try:
+      run_socket_worker(argv[1])
+    except KeyboardInterrupt:
+      pass
+    except OSError as e:
+      print(f"Error: {e}", file=sys.stderr)
+      return 2
+    return 0
+  try:
+    if len(argv) < 1 or argv == ['--json']:
+      print("Usage: python video_cdn_helper.py [--json] [--progress] <video_path>", file=sys.stderr)
+      print("       python video_cdn_helper.py --worker", file=sys.stderr)
+      print("       python video_cdn_helper.py --socket <socket_path>", file=sys.stderr)
+      print("       python video_cdn_helper.py --batch <video_path> [<video_path> ...]", file=sys.stderr)
+      return 1
+    as_json = argv[0] == '--json'
+    if as_json:
+      argv = argv[1:]
+    video_path = argv[0]
     print(f"[DEBUG] Video CDN Helper v2.1 - Updated FFmpeg commands", file=sys.stderr)
     print(f"[DEBUG] Input video path: {video_path}", file=sys.stderr)
-    url = process_and_upload_video(video_path)
-    print(f"[DEBUG] Final URL to return: {url}", file=sys.stderr)
-    print(url)
+    result = process_video(video_path)
+    print(f"[DEBUG] Final URL to return: {result['url']}", file=sys.stderr)
+    print(json.dumps(result) if as_json else result['url'])
+    return 0
   except Exception as e:
     error_message = str(e)
     print(f"Error: {error_message}", file=sys.stderr)
 
     # Use specific exit codes for different types of errors
-    if "corrupted and cannot be processed" in error_message:
-      sys.exit(3)  # Exit code 3 for corrupted files
-    else:
-      sys.exit(2)  # Exit code 2 for other errors
+    return exit_code_for_error(e)
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))